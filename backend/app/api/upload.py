@@ -12,6 +12,7 @@ from app.database import get_db
 from app.config import get_settings
 from app.models.import_task import ImportTask
 from app.models.import_job import ImportJob
+from app.workers.import_worker import notify_job_enqueued, get_live_progress
 
 router = APIRouter()
 settings = get_settings()
@@ -22,16 +23,16 @@ MAX_TASKS = 15
 
 async def cleanup_old_tasks(db: AsyncSession):
     """清理超过最大数量的旧任务"""
-    # 获取所有任务按开始时间降序
-    stmt = select(ImportTask).order_by(ImportTask.started_at.desc())
-    result = await db.execute(stmt)
-    tasks = result.scalars().all()
-    
-    # 如果超过15条，删除旧的
-    if len(tasks) > MAX_TASKS:
-        old_task_ids = [t.task_id for t in tasks[MAX_TASKS:]]
-        await db.execute(delete(ImportTask).where(ImportTask.task_id.in_(old_task_ids)))
-        await db.execute(delete(ImportJob).where(ImportJob.task_id.in_(old_task_ids)))
+    # 按开始时间降序跳过最新的 MAX_TASKS 条，其余在 SQL 里直接删除（先删队列任务，再删任务记录）
+    old_task_ids = (
+        select(ImportTask.task_id)
+        .order_by(ImportTask.started_at.desc())
+        .offset(MAX_TASKS)
+        .scalar_subquery()
+    )
+    await db.execute(delete(ImportJob).where(ImportJob.task_id.in_(old_task_ids)))
+    deleted = await db.execute(delete(ImportTask).where(ImportTask.task_id.in_(old_task_ids)))
+    if deleted.rowcount:
         await db.commit()
 
 
@@ -102,6 +103,7 @@ async def upload_orders(
         )
         db.add(job)
         await db.commit()
+        notify_job_enqueued()
         
         return {
             "message": "订单文件已上传，已进入队列，后台将自动导入并计算统计。",
@@ -148,6 +150,7 @@ async def upload_aftersales(
         )
         db.add(job)
         await db.commit()
+        notify_job_enqueued()
         
         return {
             "message": "售后单文件已上传，已进入队列，后台将自动导入并计算统计。",
@@ -200,6 +203,7 @@ async def upload_all_and_calculate(
         )
         db.add(job)
         await db.commit()
+        notify_job_enqueued()
         
         return {
             "message": "文件已上传，已进入队列，后台将自动导入并计算统计。",
@@ -212,6 +216,14 @@ async def upload_all_and_calculate(
         aftersales_file.file.close()
 
 
+def _task_dict(task: ImportTask) -> dict:
+    """任务详情：进行中的任务优先展示 worker 的实时进度（同进程时可用）"""
+    data = task.to_dict()
+    if task.status == "processing":
+        data["progress"] = get_live_progress(task.task_id) or data["progress"]
+    return data
+
+
 @router.get("/status/{task_id}")
 async def get_import_status(task_id: str, db: AsyncSession = Depends(get_db)):
     """查询导入任务状态"""
@@ -222,7 +234,7 @@ async def get_import_status(task_id: str, db: AsyncSession = Depends(get_db)):
     if not task:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    return task.to_dict()
+    return _task_dict(task)
 
 
 @router.get("/tasks")
@@ -233,7 +245,7 @@ async def list_import_tasks(db: AsyncSession = Depends(get_db)):
     tasks = result.scalars().all()
     
     return {
-        "tasks": [t.to_dict() for t in tasks],
+        "tasks": [_task_dict(t) for t in tasks],
         "count": len(tasks),
     }
 
@@ -21,6 +21,10 @@ class Settings(BaseSettings):
     # 是否启用导入 Worker（生产/多进程部署时可关闭，改用单独 worker 进程）
     enable_import_worker: bool = True
     import_worker_poll_interval: float = 1.0
+    # 同一进程内并发的导入消费循环数（导入仍按入队顺序串行；>1 时只让一个任务的统计重算与下一个任务的导入重叠）
+    import_worker_concurrency: int = 1
+    # Excel 行解析进程数（解析是 CPU 密集型，放到子进程避免占用主进程 GIL；0 表示在线程池里解析；不超过 CPU 核数 - 1）
+    import_parse_workers: int = 2
     
     # 服务配置
     api_host: str = "0.0.0.0"
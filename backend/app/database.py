@@ -1,7 +1,7 @@
 """
 数据库连接和会话管理
 """
-from sqlalchemy import text
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 
@@ -16,9 +16,26 @@ engine_kwargs = {
 # SQLite 导入期间容易出现读写锁竞争：适当加大 timeout，并在 init_db 里启用 WAL
 if settings.database_url.startswith("sqlite"):
     engine_kwargs["connect_args"] = {"timeout": 60}
+# 每个导入消费循环各占一个连接：在连接池默认大小（5）之上为它们留出余量，避免挤占 API 请求
+if settings.import_worker_concurrency > 1:
+    engine_kwargs["pool_size"] = 5 + settings.import_worker_concurrency
 
 engine = create_async_engine(settings.database_url, **engine_kwargs)
 
+if settings.database_url.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        连接级 PRAGMA（synchronous/temp_store 只对当前连接生效，必须在每个池化连接建立时设置）
+
+        WAL + synchronous=NORMAL：commit 不再逐次 fsync，仅在 checkpoint 时落盘，导入按批 commit 不再被磁盘同步拖慢。
+        代价：断电时可能丢失最近几次提交（不会损坏库）；导入基于 upsert 幂等，中断后重新导入即可。
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # 创建异步会话工厂
 async_session_maker = async_sessionmaker(
     engine,
@@ -44,11 +61,9 @@ async def get_db() -> AsyncSession:
 async def init_db():
     """初始化数据库表"""
     async with engine.begin() as conn:
-        # SQLite 性能/并发优化（WAL 会持久化到 DB 文件，设置一次即可）
+        # SQLite 性能/并发优化（WAL 会持久化到 DB 文件，设置一次即可；synchronous/temp_store 见连接事件）
         if settings.database_url.startswith("sqlite"):
             await conn.execute(text("PRAGMA journal_mode=WAL;"))
-            await conn.execute(text("PRAGMA synchronous=NORMAL;"))
-            await conn.execute(text("PRAGMA temp_store=MEMORY;"))
             await conn.execute(text("PRAGMA foreign_keys=ON;"))
             await conn.execute(text("PRAGMA busy_timeout=60000;"))
         await conn.run_sync(Base.metadata.create_all)
@@ -75,6 +90,58 @@ async def init_db():
             await _ensure_column("order_skus", "sku_code_raw", "sku_code_raw VARCHAR(128)")
             await _ensure_column("after_sales", "sku_code_raw", "sku_code_raw VARCHAR(128)")
 
+            # after_sales：售后未完结标记 + 部分索引（新列按既有状态一次性回填）
+            if "is_pending" not in await _table_columns("after_sales"):
+                await _ensure_column("after_sales", "is_pending", "is_pending BOOLEAN NOT NULL DEFAULT 0")
+                await conn.execute(
+                    text("UPDATE after_sales SET is_pending = 1 WHERE aftersale_status IN (1, 2, 3, 4)")
+                )
+            await conn.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_after_sales_pending ON after_sales (is_pending) WHERE is_pending = 1")
+            )
+
+            # after_sales：品质退货统计口径标记（新列按原因文本一次性回填，并让按日预聚合表重算全部支付日）
+            if "is_quality_reason" not in await _table_columns("after_sales"):
+                from app.services.stats_service import StatsService  # local import to avoid import-time overhead
+
+                await _ensure_column(
+                    "after_sales", "is_quality_reason", "is_quality_reason BOOLEAN NOT NULL DEFAULT 0"
+                )
+                matches = " OR ".join(
+                    f"instr(reason_text, :reason_{i}) > 0" for i in range(len(StatsService.QUALITY_REASON_TEXTS))
+                )
+                await conn.execute(
+                    text(f"UPDATE after_sales SET is_quality_reason = 1 WHERE {matches}"),
+                    {f"reason_{i}": reason for i, reason in enumerate(StatsService.QUALITY_REASON_TEXTS)},
+                )
+                await conn.execute(
+                    text(
+                        """
+                        INSERT OR IGNORE INTO sku_daily_stats_dirty (pay_date)
+                        SELECT DISTINCT date(pay_time) FROM orders WHERE pay_time IS NOT NULL
+                        """
+                    )
+                )
+
+            # 统计查询的覆盖索引（create_all 不会给已有表补索引）
+            await conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_orders_pay_time_cover "
+                    "ON orders (pay_time, order_id, is_signed, order_status, province_name)"
+                )
+            )
+            await conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_after_sales_order_cover ON after_sales "
+                    "(order_id, sku_code, aftersale_status, aftersale_type, is_quality_reason, province_name)"
+                )
+            )
+
+            # import_tasks：清理旧任务按开始时间倒序取最新 N 条
+            await conn.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_import_tasks_started_at ON import_tasks (started_at)")
+            )
+
             # 一次性归一化（轻量）：将历史数据的 sku_code_raw 补齐，并清洗 sku_code
             # 说明：SQLite 不支持正则替换，这里用 Python 做清洗并按需更新；仅在 sku_code_raw 为空的历史库上起作用
             from app.utils.sku_code import clean_sku_code  # local import to avoid import-time overhead
@@ -129,3 +196,119 @@ async def init_db():
             await _backfill_table("order_skus")
             await _backfill_table("after_sales")
 
+            # 金额字段由“元（浮点）”改为“分（整数）”：历史库一次性换算，用 user_version 标记避免重复执行
+            schema_version = (await conn.execute(text("PRAGMA user_version"))).scalar() or 0
+            if schema_version < 1:
+                for table_name, amount_columns in (
+                    ("orders", ("total_amount", "pay_amount")),
+                    ("order_skus", ("price",)),
+                    ("after_sales", ("refund_amount",)),
+                ):
+                    assignments = ", ".join(
+                        f"{col} = CAST(ROUND(COALESCE({col}, 0) * 100) AS INTEGER)" for col in amount_columns
+                    )
+                    await conn.execute(text(f"UPDATE {table_name} SET {assignments}"))
+                await conn.execute(text("PRAGMA user_version = 1"))
+
+            # SKU 按日预聚合表（sku_daily_stats）：历史库上首次启用时把所有支付日标记为待刷新，由统计服务首次计算时回填
+            if schema_version < 2:
+                await conn.execute(
+                    text(
+                        """
+                        INSERT OR IGNORE INTO sku_daily_stats_dirty (pay_date)
+                        SELECT DISTINCT date(pay_time) FROM orders WHERE pay_time IS NOT NULL
+                        """
+                    )
+                )
+                await conn.execute(text("PRAGMA user_version = 2"))
+
+            # after_sales 的脏日期触发器改为跟踪 is_quality_reason（统计只用该标记，原因文本改动但口径不变时不必重算）：
+            # 删掉旧版本触发器，由下方 CREATE TRIGGER IF NOT EXISTS 按新列重建
+            if schema_version < 3:
+                await conn.execute(text("DROP TRIGGER IF EXISTS trg_after_sales_sku_daily_dirty_update"))
+                await conn.execute(text("PRAGMA user_version = 3"))
+
+            # 退货退款（aftersale_type=1）意味着买家已收货并退回：由触发器直接标记关联订单为已签收，
+            # 导入 upsert 时随售后写入一并完成，省掉每批次额外的一次 UPDATE orders 扫描
+            for event_name, event_clause in (("insert", "INSERT"), ("update", "UPDATE OF aftersale_type, order_id")):
+                await conn.execute(
+                    text(
+                        f"""
+                        CREATE TRIGGER IF NOT EXISTS trg_after_sales_refund_signed_{event_name}
+                        AFTER {event_clause} ON after_sales
+                        WHEN NEW.aftersale_type = 1 AND NEW.order_id IS NOT NULL
+                        BEGIN
+                            UPDATE orders
+                            SET is_signed = 1, updated_at = datetime('now', 'localtime')
+                            WHERE order_id = NEW.order_id AND is_signed = 0;
+                        END
+                        """
+                    )
+                )
+
+            # sku_daily_stats：订单/明细/售后写入时，把受影响订单的支付日记入 sku_daily_stats_dirty，统计时只重算这些天。
+            # 只在影响统计口径的列真正变化时标记：重复导入/同步的 upsert 值不变，不会触发整段重算。
+            # 注意：触发器内不能用 INSERT OR IGNORE（会被外层 upsert 语句的冲突策略覆盖），改用 ON CONFLICT DO NOTHING
+            order_pay_date = "SELECT date(pay_time) FROM orders WHERE order_id = {row}.order_id AND pay_time IS NOT NULL"
+            dirty_sources = {
+                "orders": (
+                    ("pay_time", "order_status", "is_signed"),
+                    "SELECT date({row}.pay_time) WHERE {row}.pay_time IS NOT NULL",
+                ),
+                "order_skus": (("order_id", "sku_code", "sku_name", "product_name"), order_pay_date),
+                "after_sales": (
+                    ("order_id", "sku_code", "aftersale_status", "aftersale_type", "is_quality_reason"),
+                    order_pay_date,
+                ),
+            }
+            for table_name, (tracked_columns, pay_date_select) in dirty_sources.items():
+                changed = " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in tracked_columns)
+                for event_name, event_clause, when_clause, rows in (
+                    ("insert", "INSERT", "", ("NEW",)),
+                    ("update", f"UPDATE OF {', '.join(tracked_columns)}", f"WHEN {changed}", ("OLD", "NEW")),
+                    ("delete", "DELETE", "", ("OLD",)),
+                ):
+                    statements = "\n".join(
+                        f"INSERT INTO sku_daily_stats_dirty (pay_date) {pay_date_select.format(row=row)} ON CONFLICT (pay_date) DO NOTHING;"
+                        for row in rows
+                    )
+                    await conn.execute(
+                        text(
+                            f"""
+                            CREATE TRIGGER IF NOT EXISTS trg_{table_name}_sku_daily_dirty_{event_name}
+                            AFTER {event_clause} ON {table_name}
+                            {when_clause}
+                            BEGIN
+                                {statements}
+                            END
+                            """
+                        )
+                    )
+
+            # order_skus：(order_id, sku_id) 唯一索引（同步/导入 upsert 的冲突键）
+            # 说明：create_all 不会给已有表补索引；历史库可能存在重复行，先按 (order_id, sku_id) 去重（保留最新一条）再建索引。
+            # 旧版本的 (order_id, sku_code) 唯一索引会让同一订单下编码为空/相同的平台 SKU 互相冲突，一并删除。
+            index_exists = await conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uix_order_sku_id'")
+            )
+            if index_exists.first() is None:
+                await conn.execute(text("DROP INDEX IF EXISTS uix_order_sku_code"))
+                await conn.execute(
+                    text(
+                        """
+                        DELETE FROM order_skus
+                        WHERE id NOT IN (
+                            SELECT MAX(id) FROM order_skus
+                            GROUP BY order_id, sku_id
+                        )
+                        """
+                    )
+                )
+                await conn.execute(
+                    text("CREATE UNIQUE INDEX IF NOT EXISTS uix_order_sku_id ON order_skus (order_id, sku_id)")
+                )
+
+            # 刷新查询规划器统计信息（sqlite_stat1），让部分索引/复合索引能被正确选用；
+            # analysis_limit 限制每个索引的采样行数，大库上启动也只需毫秒级
+            await conn.execute(text("PRAGMA analysis_limit=400"))
+            await conn.execute(text("ANALYZE"))
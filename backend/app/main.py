@@ -12,6 +12,8 @@ from app.config import get_settings
 from app.database import init_db
 from app.api import api_router
 from app.workers.import_worker import ImportWorker
+from app.services.kd100_client import close_shared_client
+from app.services.excel_import import shutdown_parse_pool
 from app import models  # noqa: F401  (确保所有模型已注册到 Base.metadata，用于 create_all)
 
 settings = get_settings()
@@ -42,6 +44,8 @@ async def lifespan(app: FastAPI):
             await worker_task
         except Exception:
             pass
+    await close_shared_client()
+    shutdown_parse_pool()
 
 
 app = FastAPI(
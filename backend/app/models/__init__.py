@@ -3,10 +3,10 @@
 """
 from app.models.order import Order, OrderSku
 from app.models.after_sale import AfterSale
-from app.models.sku_stats import SkuStats
+from app.models.sku_stats import SkuStats, SkuDailyStats, SkuDailyStatsDirty
 from app.models.import_task import ImportTask
 from app.models.import_job import ImportJob
 from app.models.system_config import SystemConfig
 
-__all__ = ["Order", "OrderSku", "AfterSale", "SkuStats", "ImportTask", "ImportJob", "SystemConfig"]
+__all__ = ["Order", "OrderSku", "AfterSale", "SkuStats", "SkuDailyStats", "SkuDailyStatsDirty", "ImportTask", "ImportJob", "SystemConfig"]
 
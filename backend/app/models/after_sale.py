@@ -2,7 +2,7 @@
 售后单模型
 """
 from datetime import datetime
-from sqlalchemy import String, Integer, DateTime, Text, Float
+from sqlalchemy import String, Integer, DateTime, Text, Index, text
 from sqlalchemy.orm import Mapped, mapped_column
 from typing import Optional
 
@@ -12,6 +12,15 @@ from app.database import Base
 class AfterSale(Base):
     """售后单表"""
     __tablename__ = "after_sales"
+    __table_args__ = (
+        # 部分索引：只收录未完结售后，查询待处理售后时只扫这一小部分行
+        Index("ix_after_sales_pending", "is_pending", sqlite_where=text("is_pending = 1")),
+        # 覆盖索引：统计查询按 order_id 关联订单，所需列都在索引里，不必回表
+        Index(
+            "ix_after_sales_order_cover",
+            "order_id", "sku_code", "aftersale_status", "aftersale_type", "is_quality_reason", "province_name",
+        ),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     
@@ -30,14 +39,18 @@ class AfterSale(Base):
     aftersale_type: Mapped[int] = mapped_column(Integer, comment="售后类型: 1-退货退款 2-仅退款 3-换货")
     aftersale_status: Mapped[int] = mapped_column(Integer, index=True, comment="售后状态")
     aftersale_status_desc: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, comment="售后状态描述")
+    is_pending: Mapped[bool] = mapped_column(default=False, comment="售后是否未完结（写入时按状态计算）")
     
     # 退货原因
     reason_code: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, comment="退货原因代码")
     reason_text: Mapped[Optional[str]] = mapped_column(String(256), nullable=True, comment="退货原因文本")
     is_quality_issue: Mapped[bool] = mapped_column(default=False, comment="是否品质问题")
+    is_quality_reason: Mapped[bool] = mapped_column(
+        default=False, comment="退货原因是否计入品质退货统计（写入时按原因文本计算）"
+    )
     
     # 金额信息
-    refund_amount: Mapped[float] = mapped_column(Float, default=0, comment="退款金额")
+    refund_amount: Mapped[int] = mapped_column(Integer, default=0, comment="退款金额（分）")
     
     # 时间信息
     apply_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, comment="申请时间")
@@ -50,4 +63,9 @@ class AfterSale(Base):
     # 系统字段
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="记录创建时间")
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now, comment="记录更新时间")
+    
+    @property
+    def refund_amount_yuan(self) -> float:
+        """退款金额（元）"""
+        return (self.refund_amount or 0) / 100
 
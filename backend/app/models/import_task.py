@@ -35,7 +35,7 @@ class ImportTask(Base):
     error: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="错误信息")
     
     # 时间信息
-    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="开始时间")
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, index=True, comment="开始时间")
     completed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, comment="完成时间")
     
     def to_dict(self) -> Dict[str, Any]:
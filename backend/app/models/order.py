@@ -2,7 +2,7 @@
 订单模型
 """
 from datetime import datetime
-from sqlalchemy import String, Integer, DateTime, ForeignKey, Text, Float
+from sqlalchemy import String, Integer, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import List, Optional
 
@@ -12,6 +12,10 @@ from app.database import Base
 class Order(Base):
     """订单表"""
     __tablename__ = "orders"
+    __table_args__ = (
+        # 覆盖索引：统计查询按 pay_time 区间过滤，所需列都在索引里，不必回表
+        Index("ix_orders_pay_time_cover", "pay_time", "order_id", "is_signed", "order_status", "province_name"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     
@@ -40,9 +44,9 @@ class Order(Base):
     sign_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, comment="签收时间")
     logistics_checked: Mapped[bool] = mapped_column(default=False, comment="是否已查询物流状态")
     
-    # 金额信息
-    total_amount: Mapped[float] = mapped_column(Float, default=0, comment="订单总金额")
-    pay_amount: Mapped[float] = mapped_column(Float, default=0, comment="实付金额")
+    # 金额信息（整数分，避免浮点误差；展示用元见 *_yuan）
+    total_amount: Mapped[int] = mapped_column(Integer, default=0, comment="订单总金额（分）")
+    pay_amount: Mapped[int] = mapped_column(Integer, default=0, comment="实付金额（分）")
     
     # 系统字段
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="记录创建时间")
@@ -50,11 +54,25 @@ class Order(Base):
     
     # 关联关系
     sku_list: Mapped[List["OrderSku"]] = relationship("OrderSku", back_populates="order", cascade="all, delete-orphan")
+    
+    @property
+    def total_amount_yuan(self) -> float:
+        """订单总金额（元）"""
+        return (self.total_amount or 0) / 100
+    
+    @property
+    def pay_amount_yuan(self) -> float:
+        """实付金额（元）"""
+        return (self.pay_amount or 0) / 100
 
 
 class OrderSku(Base):
     """订单SKU表"""
     __tablename__ = "order_skus"
+    __table_args__ = (
+        # 同步/导入 upsert 的冲突键（同一订单下按 SKU ID 唯一；Excel 导入时 sku_id 即净编码）
+        Index("uix_order_sku_id", "order_id", "sku_id", unique=True),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     
@@ -75,11 +93,16 @@ class OrderSku(Base):
     
     # 数量和价格
     quantity: Mapped[int] = mapped_column(Integer, default=1, comment="购买数量")
-    price: Mapped[float] = mapped_column(Float, default=0, comment="单价")
+    price: Mapped[int] = mapped_column(Integer, default=0, comment="单价（分）")
     
     # 系统字段
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="记录创建时间")
     
     # 关联关系
     order: Mapped["Order"] = relationship("Order", back_populates="sku_list")
+    
+    @property
+    def price_yuan(self) -> float:
+        """单价（元）"""
+        return (self.price or 0) / 100
 
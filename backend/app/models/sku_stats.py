@@ -51,3 +51,32 @@ class SkuStats(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, comment="记录创建时间")
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now, comment="记录更新时间")
 
+
+class SkuDailyStats(Base):
+    """SKU 按支付日预聚合表 - 每个 (sku_code, 支付日) 一行，时间区间统计对其求和即可"""
+    __tablename__ = "sku_daily_stats"
+    __table_args__ = (
+        UniqueConstraint("sku_code", "pay_date", name="uix_sku_daily_stats"),
+    )
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    
+    sku_code: Mapped[str] = mapped_column(String(64), comment="商家SKU编码（净编码）")
+    pay_date: Mapped[str] = mapped_column(String(10), index=True, comment="订单支付日期（YYYY-MM-DD）")
+    sku_name: Mapped[Optional[str]] = mapped_column(String(256), nullable=True, comment="SKU名称")
+    product_name: Mapped[Optional[str]] = mapped_column(String(256), nullable=True, comment="商品名称")
+    
+    # 当日订单数（按订单去重；一个订单只有一个支付日，跨天求和仍是去重口径）
+    pending_ship_count: Mapped[int] = mapped_column(Integer, default=0, comment="待发货订单数")
+    in_transit_count: Mapped[int] = mapped_column(Integer, default=0, comment="在途未签收订单数")
+    aftersale_pending_count: Mapped[int] = mapped_column(Integer, default=0, comment="售后未完结订单数")
+    signed_return_count: Mapped[int] = mapped_column(Integer, default=0, comment="已签收退货订单数")
+    quality_return_count: Mapped[int] = mapped_column(Integer, default=0, comment="品质退货订单数")
+    signed_count: Mapped[int] = mapped_column(Integer, default=0, comment="已签收订单数")
+
+
+class SkuDailyStatsDirty(Base):
+    """待刷新的支付日 - 由 orders/order_skus/after_sales 上的触发器写入，刷新预聚合表后清空"""
+    __tablename__ = "sku_daily_stats_dirty"
+    
+    pay_date: Mapped[str] = mapped_column(String(10), primary_key=True, comment="订单支付日期（YYYY-MM-DD）")
@@ -1,7 +1,7 @@
 """
 售后单相关 Schema
 """
-from pydantic import BaseModel
+from pydantic import AliasChoices, BaseModel, Field
 from datetime import datetime
 from typing import Optional, List
 
@@ -24,7 +24,8 @@ class AfterSaleSchema(BaseModel):
     is_quality_issue: bool = False
     
     # 金额
-    refund_amount: float = 0
+    # 库里按分存储，接口仍返回元
+    refund_amount: float = Field(0, validation_alias=AliasChoices("refund_amount_yuan", "refund_amount"))
     
     # 时间
     apply_time: Optional[datetime] = None
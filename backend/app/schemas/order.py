@@ -1,7 +1,7 @@
 """
 订单相关 Schema
 """
-from pydantic import BaseModel
+from pydantic import AliasChoices, BaseModel, Field
 from datetime import datetime
 from typing import Optional, List
 
@@ -14,7 +14,8 @@ class OrderSkuSchema(BaseModel):
     product_id: Optional[str] = None
     product_name: Optional[str] = None
     quantity: int = 1
-    price: float = 0
+    # 库里按分存储，接口仍返回元
+    price: float = Field(0, validation_alias=AliasChoices("price_yuan", "price"))
     
     class Config:
         from_attributes = True
@@ -43,8 +44,9 @@ class OrderSchema(BaseModel):
     sign_time: Optional[datetime] = None
     
     # 金额信息
-    total_amount: float = 0
-    pay_amount: float = 0
+    # 库里按分存储，接口仍返回元
+    total_amount: float = Field(0, validation_alias=AliasChoices("total_amount_yuan", "total_amount"))
+    pay_amount: float = Field(0, validation_alias=AliasChoices("pay_amount_yuan", "pay_amount"))
     
     # SKU列表
     sku_list: List[OrderSkuSchema] = []
@@ -68,4 +68,5 @@ class StatsSummary(BaseModel):
     total_stock_gap: int = 0             # 总商品缺口
     last_import_time: Optional[datetime] = None  # 最后导入时间
     last_calculated_at: Optional[datetime] = None  # 最后计算时间
+    pending_refresh_days: int = 0        # 待刷新的日聚合天数（>0 表示统计尚未包含最新导入）
 
@@ -1,20 +1,33 @@
 """
 抖音开放平台 API 客户端
 """
+import asyncio
 import hashlib
 import time
 import json
-from typing import Any, Dict, Optional
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 import httpx
 
 from app.config import get_settings
 
 settings = get_settings()
 
+# 详情类接口的短 TTL 响应缓存（进程内共享，跨 DouyinClient 实例生效）：
+# 多个同步任务时间窗口重叠时，同一订单/售后单的详情与物流不会在短时间内重复请求
+_CacheKey = Tuple[str, str, str, str]
+_response_cache: "OrderedDict[_CacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+# 进行中的请求：并发的重复请求等待同一个 Future，而不是各自发起
+_inflight: Dict[_CacheKey, "asyncio.Future[Dict[str, Any]]"] = {}
+
 
 class DouyinClient:
     """抖音开放平台 API 客户端"""
     
+    # 详情类响应缓存：有效期（秒）与最大条目数
+    DETAIL_CACHE_TTL = 30.0
+    DETAIL_CACHE_MAXSIZE = 4096
+    
     def __init__(self, access_token: str = ""):
         self.base_url = settings.douyin_api_base_url
         self.app_key = settings.douyin_app_key
@@ -81,6 +94,42 @@ class DouyinClient:
         
         return result.get("data", {})
     
+    async def _cached_request(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        带短 TTL 缓存与并发去重的请求（仅用于只读的详情类接口）
+        
+        注意：返回的 dict 会被多个调用方共享，调用方只读不改。
+        """
+        key = (self.app_key, self.shop_id, method, json.dumps(params, sort_keys=True, separators=(",", ":")))
+        now = time.monotonic()
+        
+        hit = _response_cache.get(key)
+        if hit is not None and hit[0] > now:
+            _response_cache.move_to_end(key)
+            return hit[1]
+        
+        pending = _inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        
+        future: "asyncio.Future[Dict[str, Any]]" = asyncio.get_running_loop().create_future()
+        _inflight[key] = future
+        try:
+            data = await self._request(method, params)
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # 标记已读取：没有并发等待者时避免 "exception was never retrieved" 告警
+            raise
+        finally:
+            _inflight.pop(key, None)
+        
+        future.set_result(data)
+        _response_cache[key] = (time.monotonic() + self.DETAIL_CACHE_TTL, data)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > self.DETAIL_CACHE_MAXSIZE:
+            _response_cache.popitem(last=False)
+        return data
+    
     async def get_order_list(
         self,
         start_time: Optional[int] = None,
@@ -129,7 +178,7 @@ class DouyinClient:
         params = {
             "shop_order_id": order_id,
         }
-        return await self._request("order.orderDetail", params)
+        return await self._cached_request("order.orderDetail", params)
     
     async def get_aftersale_list(
         self,
@@ -179,7 +228,7 @@ class DouyinClient:
         params = {
             "aftersale_id": aftersale_id,
         }
-        return await self._request("afterSale.Detail", params)
+        return await self._cached_request("afterSale.Detail", params)
     
     async def get_logistics_track(self, order_id: str) -> Dict[str, Any]:
         """
@@ -194,7 +243,7 @@ class DouyinClient:
         params = {
             "order_id": order_id,
         }
-        return await self._request("logistics.trackNoRouteDetail", params)
+        return await self._cached_request("logistics.trackNoRouteDetail", params)
     
     async def close(self):
         """关闭客户端连接"""
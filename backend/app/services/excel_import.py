@@ -1,18 +1,67 @@
 """
 Excel 数据导入服务 - 批量优化版本
 """
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from typing import Dict, Any, List, Optional, Set
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Set, Tuple, Callable, Awaitable, Hashable, Iterator
 import anyio
-from sqlalchemy import select, update, and_, delete, case
+from python_calamine import CalamineWorkbook
+from pandas.io.parsers import TextParser
+from sqlalchemy import select, and_, delete, case, tuple_
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.config import get_settings
 from app.models.order import Order, OrderSku
 from app.models.after_sale import AfterSale
 from app.services.kd100_client import parse_express_info
-from app.utils.sku_code import clean_sku_code
+from app.services.order_service import OrderService
+from app.services.stats_service import StatsService
+from app.utils.sku_code import clean_sku_code_series
+
+logger = logging.getLogger(__name__)
+
+# 一批解析结果：(主记录, 附属数据, 批次统计)
+ParsedBatch = Tuple[List[Dict[str, Any]], Any, Dict[str, int]]
+# 导入进度回调：参数为已写入的有效行数
+ProgressCallback = Callable[[int], Awaitable[None]]
+
+# 行解析进程池（惰性创建，全进程共享；应用关闭时调用 shutdown_parse_pool() 释放）
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """获取（惰性创建）行解析进程池；没有可用的进程数时返回 None，退回线程池解析"""
+    global _parse_pool
+    # 子进程只有在主进程之外还有空闲核时才有意义；单核机器上只会多出进程间序列化开销
+    workers = min(get_settings().import_parse_workers, (os.cpu_count() or 1) - 1)
+    if workers <= 0:
+        return None
+    if _parse_pool is None:
+        # spawn：子进程不继承父进程的事件循环、线程与 DB 连接
+        _parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _parse_pool
+
+
+def shutdown_parse_pool():
+    """关闭行解析进程池（应用关闭时调用）"""
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+def _parse_batch_in_process(parser_name: str, batch_df: pd.DataFrame) -> ParsedBatch:
+    """进程池入口（需为模块级函数才能 pickle）：解析不访问 DB，用不带会话的服务实例调用同名解析方法"""
+    return getattr(ExcelImportService(None), parser_name)(batch_df)
 
 
 class ExcelImportService:
@@ -23,13 +72,18 @@ class ExcelImportService:
     # SQLite 默认变量上限 999；给点余量避免不同语句/方言额外占用
     SQLITE_IN_CLAUSE_CHUNK_SIZE = 500
     SQLITE_MAX_SQL_VARS = 900
+    # 解析/写入流水线缓冲的批次数（预解析批次会常驻内存）
+    PIPELINE_BUFFER_SIZE = 2
     
-    # 订单状态映射
+    # 订单状态映射（键做 intern：与行循环里驻留过的状态字符串比较时直接指针相等）
     ORDER_STATUS_MAP = {
-        "待发货": 2,
-        "已发货": 3,
-        "已完成": 5,
-        "已关闭": 4,
+        sys.intern(k): v
+        for k, v in {
+            "待发货": 2,
+            "已发货": 3,
+            "已完成": 5,
+            "已关闭": 4,
+        }.items()
     }
     
     # 售后状态映射（判断是否未完结）
@@ -38,6 +92,13 @@ class ExcelImportService:
         "待商家收货",
         "待商家处理",
     ]
+
+    # 品质问题关键词（售后原因包含任一即视为品质问题）
+    QUALITY_KEYWORDS = ["质量", "破损", "与描述不符", "假货", "品质"]
+
+    # 关键词合并为单个正则：整批一次向量化匹配，代替逐行多次子串扫描
+    _AFTERSALE_PENDING_RE = re.compile("|".join(map(re.escape, AFTERSALE_PENDING_STATUS)))
+    _QUALITY_RE = re.compile("|".join(map(re.escape, QUALITY_KEYWORDS)))
     
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -49,64 +110,206 @@ class ExcelImportService:
         size = max(int(chunk_size), 1)
         return [items[i : i + size] for i in range(0, len(items), size)]
 
-    def _chunk_records_by_sql_vars(self, records: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    def _chunk_orders_by_sql_vars(self, skus_by_order: Dict[str, List[str]]) -> List[List[str]]:
         """
-        按 SQLite 单条语句变量上限分片 records，避免多行 INSERT/UPSERT 触发 'too many SQL variables'。
-        
-        注意：SQLAlchemy 在 INSERT 时可能会把带 python-side default 的列也写进 SQL（即使 dict 没显式提供），
-        因此“用 dict keys 数量估算列数”在某些环境会偏小，导致仍然超过 999。
-        
-        这里采用保守策略：假设每行最多 ~22 列，固定将每条语句行数控制在 <=40（40*22=880 < 900）。
+        按累计变量数将订单分片：每个订单占 1 个变量（order_id IN），每个 (order_id, sku_id) 占 2 个变量（NOT IN），
+        每片不超过 SQLITE_MAX_SQL_VARS
         """
-        if not records:
-            return []
-        rows_per_stmt = 40
-        return [records[i : i + rows_per_stmt] for i in range(0, len(records), rows_per_stmt)]
-    
-    async def import_orders(self, file_path: str) -> Dict[str, int]:
+        chunks: List[List[str]] = []
+        chunk: List[str] = []
+        chunk_vars = 0
+        for order_id, sku_ids in skus_by_order.items():
+            order_vars = 1 + 2 * len(sku_ids)
+            if chunk and chunk_vars + order_vars > self.SQLITE_MAX_SQL_VARS:
+                chunks.append(chunk)
+                chunk, chunk_vars = [], 0
+            chunk.append(order_id)
+            chunk_vars += order_vars
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def import_orders(self, file_path: str, on_progress: Optional[ProgressCallback] = None) -> Dict[str, int]:
         """
         批量导入订单数据
         
         Args:
             file_path: Excel文件路径
+            on_progress: 每批写入提交后回调（参数为累计有效行数），用于更新任务进度
         
         Returns:
             导入统计信息
         """
-        # pandas 解析 Excel 是阻塞操作：放到线程池，避免阻塞 FastAPI 事件循环
-        df = await anyio.to_thread.run_sync(pd.read_excel, file_path)
+        return await self._run_batch_pipeline(
+            file_path, self._parse_order_batch, self._write_order_batch, on_progress
+        )
+
+    async def _run_batch_pipeline(
+        self,
+        file_path: str,
+        parse_batch: Callable[[pd.DataFrame], ParsedBatch],
+        write_batch: Callable[[ParsedBatch], Awaitable[Dict[str, int]]],
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> Dict[str, int]:
+        """
+        分批流水线：读取线程按批读 Excel，行解析提交到进程池，消费者按顺序写入/提交
+
+        说明：SQLite 单写者，DB 写入仍然只用当前这一个 AsyncSession 串行执行；
+        这里重叠的是“读 Excel（线程）+ 行解析（子进程，不占主进程 GIL）”与“upsert + commit（I/O）”。
+        流里放的是解析中的 future，缓冲区大小同时限制了在途批次数；Python 侧的行对象只按批创建。
+        """
         stats = {"total": 0, "created": 0, "updated": 0, "skipped": 0}
-        
-        # 分批处理
-        total_rows = len(df)
-        for batch_start in range(0, total_rows, self.BATCH_SIZE):
-            batch_end = min(batch_start + self.BATCH_SIZE, total_rows)
-            batch_df = df.iloc[batch_start:batch_end]
-            
-            batch_stats = await self._process_order_batch(batch_df)
-            stats["total"] += batch_stats["total"]
-            stats["created"] += batch_stats["created"]
-            stats["updated"] += batch_stats["updated"]
-            stats["skipped"] += batch_stats["skipped"]
-        
+        send_stream, receive_stream = anyio.create_memory_object_stream(max_buffer_size=self.PIPELINE_BUFFER_SIZE)
+        loop = asyncio.get_running_loop()
+        pool = _get_parse_pool()
+        # 已提交、尚未被消费者取走的解析 future（提前结束时统一取消/回收）
+        in_flight: Set[asyncio.Future] = set()
+
+        def submit_parse(batch_df: pd.DataFrame) -> asyncio.Future:
+            if pool is None:
+                future = loop.run_in_executor(None, parse_batch, batch_df)
+            else:
+                future = loop.run_in_executor(pool, _parse_batch_in_process, parse_batch.__name__, batch_df)
+            in_flight.add(future)
+            return future
+
+        # 打开工作簿同样是阻塞操作；放在流水线之外，文件不存在/格式错误时直接抛出原始异常
+        workbook = await anyio.to_thread.run_sync(self._open_workbook, file_path)
+        try:
+            batches = self._iter_excel_batches(workbook)
+
+            async def produce():
+                async with send_stream:
+                    while True:
+                        batch_df = await anyio.to_thread.run_sync(next, batches, None)
+                        if batch_df is None:
+                            break
+                        await send_stream.send(submit_parse(batch_df))
+
+            try:
+                async with anyio.create_task_group() as tg:
+                    tg.start_soon(produce)
+                    async with receive_stream:
+                        async for pending in receive_stream:
+                            in_flight.discard(pending)
+                            batch_stats = await write_batch(await pending)
+                            stats["total"] += batch_stats["total"]
+                            stats["created"] += batch_stats["created"]
+                            stats["updated"] += batch_stats["updated"]
+                            stats["skipped"] += batch_stats["skipped"]
+                            if on_progress is not None:
+                                await on_progress(stats["total"])
+            except Exception as exc:
+                # 任务组会把异常包成 ExceptionGroup；只有一个时抛出原始异常，任务错误信息不变成“unhandled errors in a TaskGroup”
+                inner = getattr(exc, "exceptions", None)
+                if inner is not None and len(inner) == 1:
+                    raise inner[0] from None
+                raise
+        finally:
+            # 提前结束（解析/写入失败等）时，流里排队的解析 future 不会再被取走：取消未开始的、等待已在执行的，
+            # 并回收它们的异常，避免在真正的错误之外再刷出 "Future exception was never retrieved"
+            for future in in_flight:
+                future.cancel()
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            # 同样要关闭文件句柄
+            workbook.close()
+
         return stats
+
+    @staticmethod
+    def _open_workbook(file_path: str) -> CalamineWorkbook:
+        """打开工作簿（calamine：Rust 实现的原生 XLSX 解析，不在 Python 里逐个单元格处理 XML）"""
+        return CalamineWorkbook.from_path(file_path)
+
+    def _iter_excel_batches(self, workbook: CalamineWorkbook) -> Iterator[pd.DataFrame]:
+        """
+        按批读取第一个工作表，每 BATCH_SIZE 行产出一个 DataFrame（同步生成器，需在线程里驱动）
+
+        单元格取值与每批的 DataFrame 构造沿用 pd.read_excel 的口径（空单元格按缺失值、
+        整数值浮点转 int、默认 NA 字符串识别与列类型推断），解析函数看到的数据与整表读取一致；
+        区别只在于列类型按批推断。
+        """
+        sheet = workbook.get_sheet_by_index(0)
+        # calamine 从有数据的首列开始返回；前面的空列补回来，列位置与整表读取一致
+        leading_blanks = [""] * (sheet.start[1] if sheet.start else 0)
+        rows = (leading_blanks + values for values in sheet.iter_rows())
+
+        header = self._trim_excel_row(next(rows, ()))
+        if not header:
+            return
+        width = len(header)
+
+        batch: List[List[Any]] = []
+        # 连续空行先暂存：后面还有数据才补进批次，与 pd.read_excel 丢弃表尾空行一致
+        pending_blank_rows = 0
+        for values in rows:
+            row = self._trim_excel_row(values)
+            if not row:
+                pending_blank_rows += 1
+                continue
+            for _ in range(pending_blank_rows):
+                batch.append([""] * width)
+                if len(batch) >= self.BATCH_SIZE:
+                    yield self._excel_batch_frame(header, batch)
+                    batch = []
+            pending_blank_rows = 0
+
+            # 超出表头的列没有列名，解析时也不会用到，直接截断；不足的补空
+            row = row[:width]
+            row.extend([""] * (width - len(row)))
+            batch.append(row)
+            if len(batch) >= self.BATCH_SIZE:
+                yield self._excel_batch_frame(header, batch)
+                batch = []
+
+        if batch:
+            yield self._excel_batch_frame(header, batch)
+
+    @staticmethod
+    def _trim_excel_row(values) -> List[Any]:
+        """按 pd.read_excel 口径转换一行单元格值，并去掉行尾空单元格"""
+        row = []
+        for value in values:
+            if value is None:
+                value = ""
+            elif isinstance(value, float) and value.is_integer():
+                value = int(value)
+            elif type(value) is date:
+                # 纯日期单元格按 datetime 处理（与 read_excel 一致）
+                value = datetime(value.year, value.month, value.day)
+            row.append(value)
+        while row and row[-1] == "":
+            row.pop()
+        return row
+
+    @staticmethod
+    def _excel_batch_frame(header: List[Any], batch: List[List[Any]]) -> pd.DataFrame:
+        """用 pandas 读 Excel 时同一个 TextParser 构造一批 DataFrame（表头去重、NA 识别、类型推断）"""
+        return TextParser([header] + batch, header=0, skip_blank_lines=False).read()
     
-    async def _process_order_batch(self, batch_df: pd.DataFrame) -> Dict[str, int]:
-        """处理一批订单数据"""
+    def _parse_order_batch(self, batch_df: pd.DataFrame) -> ParsedBatch:
+        """解析一批订单数据（纯 CPU，不访问 DB，可在线程池执行）"""
         stats = {"total": 0, "created": 0, "updated": 0, "skipped": 0}
         
+        sku_code_raws, sku_codes = self._sku_code_columns(batch_df)
+        
         # 1. 解析所有记录
         records = []
         sku_records = []
+        # 整批共用一个时间戳（created_at 仅插入时生效，upsert 更新不会覆盖）
+        now = datetime.now()
         
-        for _, row in batch_df.iterrows():
+        # to_dict("records") 整批一次性转换为 dict 行，避免 iterrows 逐行构造 Series
+        for i, row in enumerate(batch_df.to_dict("records")):
             order_id = str(row.get("子订单编号", "")).strip()
             if not order_id or order_id == "nan":
                 stats["skipped"] += 1
                 continue
             
             # 解析订单数据
-            order_status_str = str(row.get("订单状态", "")).strip()
+            # 状态/省份取值种类极少：intern 后查表与比较走指针相等，整批记录也共享同一字符串对象
+            order_status_str = sys.intern(str(row.get("订单状态", "")).strip())
             express_str = str(row.get("快递信息", "")).strip()
             express_info = parse_express_info(express_str)
             
@@ -118,37 +321,45 @@ class ExcelImportService:
                 "pay_time": self._parse_datetime(row.get("支付完成时间")),
                 "update_time": self._parse_datetime(row.get("订单完成时间")),
                 "receiver_name": str(row.get("收件人", "")).strip(),
-                "province_name": str(row.get("省", "")).strip(),
+                "province_name": sys.intern(str(row.get("省", "")).strip()),
                 "city_name": str(row.get("市", "")).strip(),
                 "logistics_code": express_info["tracking_number"],
                 "logistics_company": express_info.get("company_name", ""),
                 # 已完成订单：导入时默认标记为已签收
                 # 注意：upsert 更新时会“保留已签收=true”，避免被导入的 False 覆盖掉物流/售后推断出的 True
                 "is_signed": order_status_str == "已完成",
-                "updated_at": datetime.now(),
+                "created_at": now,
+                "updated_at": now,
             }
             records.append(order_data)
             
             # 解析 SKU 数据
-            sku_code_raw = str(row.get("商家编码", "")).strip()
-            if sku_code_raw and sku_code_raw != "nan":
-                sku_code_raw = sku_code_raw.replace("\t", "").strip()
-                sku_code = clean_sku_code(sku_code_raw)
-                if sku_code:
-                    sku_data = {
-                        "order_id": order_id,
-                        # Excel 导入场景无平台 sku_id，统一用净编码作为 sku_id（仅内部占位，统计聚合以 sku_code 为准）
-                        "sku_id": sku_code,
-                        "sku_code": sku_code,
-                        "sku_code_raw": sku_code_raw,
-                        "sku_name": str(row.get("选购商品", "")).strip(),
-                        "product_name": str(row.get("选购商品", "")).strip(),
-                        "quantity": int(row.get("商品数量", 1) or 1),
-                    }
-                    sku_records.append(sku_data)
+            sku_code = sku_codes[i]
+            if sku_code:
+                sku_code_raw = sku_code_raws[i]
+                sku_data = {
+                    "order_id": order_id,
+                    # Excel 导入场景无平台 sku_id，统一用净编码作为 sku_id（仅内部占位，统计聚合以 sku_code 为准）
+                    "sku_id": sku_code,
+                    "sku_code": sku_code,
+                    "sku_code_raw": sku_code_raw,
+                    "sku_name": str(row.get("选购商品", "")).strip(),
+                    "product_name": str(row.get("选购商品", "")).strip(),
+                    "quantity": int(row.get("商品数量", 1) or 1),
+                    "created_at": now,
+                }
+                sku_records.append(sku_data)
             
             stats["total"] += 1
         
+        # 同一批次内重复的订单/SKU 行：按主键保留最后一次出现，减少 upsert 的 VALUES 行数与索引写入
+        records = self._dedupe_records(records, lambda r: r["order_id"], "订单")
+        sku_records = self._dedupe_records(sku_records, lambda r: (r["order_id"], r["sku_id"]), "订单SKU")
+        return records, sku_records, stats
+
+    async def _write_order_batch(self, parsed: ParsedBatch) -> Dict[str, int]:
+        """写入一批已解析的订单数据"""
+        records, sku_records, stats = parsed
         if not records:
             return stats
         
@@ -161,38 +372,34 @@ class ExcelImportService:
             existing_ids.update(row[0] for row in result.all())
 
         # 3. 批量 upsert（SQLite 原生 on_conflict_do_update），避免逐条 UPDATE
-        now = datetime.now()
-        for record in records:
-            record.setdefault("created_at", now)
-
-        # 注意：SQLite 变量上限 999，多行 VALUES 需要分片执行
-        for chunk_records in self._chunk_records_by_sql_vars(records):
-            stmt = sqlite_insert(Order).values(chunk_records)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=["order_id"],
-                set_={
-                    "order_status": stmt.excluded.order_status,
-                    "order_status_desc": stmt.excluded.order_status_desc,
-                    "create_time": stmt.excluded.create_time,
-                    "pay_time": stmt.excluded.pay_time,
-                    "update_time": stmt.excluded.update_time,
-                    "receiver_name": stmt.excluded.receiver_name,
-                    "province_name": stmt.excluded.province_name,
-                    "city_name": stmt.excluded.city_name,
-                    "logistics_code": stmt.excluded.logistics_code,
-                    "logistics_company": stmt.excluded.logistics_company,
-                    # 保留已签收：若 DB 已签收=true，则不允许导入的 False 覆盖
-                    "is_signed": case(
-                        (Order.is_signed == True, True),
-                        else_=stmt.excluded.is_signed,
-                    ),
-                    "updated_at": stmt.excluded.updated_at,
-                },
-            )
-            await self.db.execute(stmt)
+        # executemany：整批复用同一条预编译语句，不用每片重新编译多行 VALUES，也不受 999 变量上限影响
+        stmt = sqlite_insert(Order)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["order_id"],
+            set_={
+                "order_status": stmt.excluded.order_status,
+                "order_status_desc": stmt.excluded.order_status_desc,
+                "create_time": stmt.excluded.create_time,
+                "pay_time": stmt.excluded.pay_time,
+                "update_time": stmt.excluded.update_time,
+                "receiver_name": stmt.excluded.receiver_name,
+                "province_name": stmt.excluded.province_name,
+                "city_name": stmt.excluded.city_name,
+                "logistics_code": stmt.excluded.logistics_code,
+                "logistics_company": stmt.excluded.logistics_company,
+                # 保留已签收：若 DB 已签收=true，则不允许导入的 False 覆盖
+                "is_signed": case(
+                    (Order.is_signed == True, True),
+                    else_=stmt.excluded.is_signed,
+                ),
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        await self.db.execute(stmt, records)
 
-        stats["created"] = sum(1 for oid in order_ids if oid not in existing_ids)
-        stats["updated"] = sum(1 for oid in order_ids if oid in existing_ids)
+        # 批内已按 order_id 去重：交集即为更新数，其余为新建
+        stats["updated"] = len(existing_ids.intersection(order_ids))
+        stats["created"] = len(order_ids) - stats["updated"]
         
         # 4. 处理 SKU 数据（批量替换该批次订单的 SKU，避免 N+1 查询）
         if sku_records:
@@ -204,113 +411,116 @@ class ExcelImportService:
         return stats
     
     async def _process_sku_batch(self, sku_records: List[Dict[str, Any]]):
-        """批量处理 SKU 数据（替换式写入）"""
+        """批量处理 SKU 数据（按 (order_id, sku_id) upsert，替换语义；Excel 行的 sku_id 即净编码）"""
         if not sku_records:
             return
 
-        order_ids = list({r["order_id"] for r in sku_records if r.get("order_id")})
-        if not order_ids:
+        sku_records = [r for r in sku_records if r.get("order_id")]
+        if not sku_records:
             return
 
-        # 1) 先删除本批次涉及订单的旧 SKU，避免重复且省掉逐条查重
-        # 注意：SQLite 变量上限 999，需分片删除
-        for chunk in self._chunk_list(order_ids, self.SQLITE_IN_CLAUSE_CHUNK_SIZE):
-            await self.db.execute(delete(OrderSku).where(OrderSku.order_id.in_(chunk)))
+        # 1) 批量 upsert：命中唯一索引 (order_id, sku_id) 时原地更新，避免先删后插导致索引页整体重写
+        # executemany 复用同一条预编译语句（同一批 records 的 keys 一致）
+        stmt = sqlite_insert(OrderSku)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["order_id", "sku_id"],
+            set_={
+                "sku_code": stmt.excluded.sku_code,
+                "sku_code_raw": stmt.excluded.sku_code_raw,
+                "sku_name": stmt.excluded.sku_name,
+                "product_name": stmt.excluded.product_name,
+                "quantity": stmt.excluded.quantity,
+            },
+        )
+        await self.db.execute(stmt, sku_records)
 
-        # 2) 批量插入新 SKU
-        now = datetime.now()
+        # 2) 替换语义：删除本批次订单下、Excel 中已不存在的旧 SKU
+        # 注意：按订单的 SKU 数累计变量数分片，控制在 SQLite 变量上限内
+        skus_by_order: Dict[str, List[str]] = {}
         for record in sku_records:
-            record.setdefault("created_at", now)
+            skus_by_order.setdefault(record["order_id"], []).append(record["sku_id"])
 
-        # 注意：SQLite 变量上限 999，多行 VALUES 需要分片执行
-        for chunk_records in self._chunk_records_by_sql_vars(sku_records):
-            stmt = sqlite_insert(OrderSku).values(chunk_records)
-            await self.db.execute(stmt)
+        for chunk in self._chunk_orders_by_sql_vars(skus_by_order):
+            keep_pairs = [(oid, sku_id) for oid in chunk for sku_id in skus_by_order[oid]]
+            await self.db.execute(
+                delete(OrderSku).where(
+                    OrderSku.order_id.in_(chunk),
+                    tuple_(OrderSku.order_id, OrderSku.sku_id).notin_(keep_pairs),
+                )
+            )
     
-    async def import_aftersales(self, file_path: str) -> Dict[str, int]:
+    async def import_aftersales(self, file_path: str, on_progress: Optional[ProgressCallback] = None) -> Dict[str, int]:
         """
         批量导入售后数据
         
         Args:
             file_path: Excel文件路径
+            on_progress: 每批写入提交后回调（参数为累计有效行数），用于更新任务进度
         
         Returns:
             导入统计信息
         """
-        # pandas 解析 Excel 是阻塞操作：放到线程池，避免阻塞 FastAPI 事件循环
-        df = await anyio.to_thread.run_sync(pd.read_excel, file_path)
-        stats = {"total": 0, "created": 0, "updated": 0, "skipped": 0}
-        
-        # 分批处理
-        total_rows = len(df)
-        for batch_start in range(0, total_rows, self.BATCH_SIZE):
-            batch_end = min(batch_start + self.BATCH_SIZE, total_rows)
-            batch_df = df.iloc[batch_start:batch_end]
-            
-            batch_stats = await self._process_aftersale_batch(batch_df)
-            stats["total"] += batch_stats["total"]
-            stats["created"] += batch_stats["created"]
-            stats["updated"] += batch_stats["updated"]
-            stats["skipped"] += batch_stats["skipped"]
-        
-        return stats
+        return await self._run_batch_pipeline(
+            file_path, self._parse_aftersale_batch, self._write_aftersale_batch, on_progress
+        )
     
-    async def _process_aftersale_batch(self, batch_df: pd.DataFrame) -> Dict[str, int]:
-        """处理一批售后数据"""
+    def _parse_aftersale_batch(self, batch_df: pd.DataFrame) -> ParsedBatch:
+        """解析一批售后数据（纯 CPU，不访问 DB，可在线程池执行）"""
         stats = {"total": 0, "created": 0, "updated": 0, "skipped": 0}
         
+        # 整批向量化分类（售后类型/售后状态/品质问题），逐行循环只取对齐后的结果
+        aftersale_type_strs = self._text_column(batch_df, "售后类型")
+        aftersale_types = np.select(
+            [
+                aftersale_type_strs.str.contains("退货", regex=False),
+                aftersale_type_strs.str.contains("退款", regex=False),
+                aftersale_type_strs.str.contains("换货", regex=False),
+            ],
+            [1, 2, 3],
+            default=0,
+        ).tolist()
+
+        aftersale_status_strs = self._text_column(batch_df, "售后状态")
+        aftersale_statuses = np.select(
+            [
+                aftersale_status_strs.str.contains(self._AFTERSALE_PENDING_RE),
+                aftersale_status_strs.str.contains("成功|退款"),
+                aftersale_status_strs.str.contains("关闭|拒绝"),
+            ],
+            [2, 5, 6],
+            default=1,
+        )
+        # 未完结标记与同步接口口径一致（按状态码判断）
+        pending_flags = np.isin(aftersale_statuses, list(OrderService.AFTERSALE_PENDING_STATUS)).tolist()
+        aftersale_statuses = aftersale_statuses.tolist()
+        aftersale_status_strs = aftersale_status_strs.tolist()
+
+        reason_texts = self._text_column(batch_df, "售后原因")
+        quality_flags = reason_texts.str.contains(self._QUALITY_RE).tolist()
+        # 品质退货统计口径与统计服务一致（按原因文本匹配 QUALITY_REASON_TEXTS）
+        quality_reason_flags = reason_texts.str.contains(StatsService.QUALITY_REASON_RE).tolist()
+        reason_texts = reason_texts.tolist()
+
+        sku_code_raws, sku_codes = self._sku_code_columns(batch_df)
+
         # 1. 解析所有记录
         records = []
         order_ids_needed = set()
+        now = datetime.now()
         
-        for _, row in batch_df.iterrows():
+        for i, row in enumerate(batch_df.to_dict("records")):
             aftersale_id = str(row.get("售后单号", "")).strip()
             if not aftersale_id or aftersale_id == "nan":
                 stats["skipped"] += 1
                 continue
             
             order_id = str(row.get("订单号", "")).strip()
-            sku_code_raw = str(row.get("商家编码", "")).strip()
-            if sku_code_raw and sku_code_raw != "nan":
-                sku_code_raw = sku_code_raw.replace("\t", "").strip()
-                sku_code = clean_sku_code(sku_code_raw)
-                if not sku_code:
-                    sku_code_raw = None
-                    sku_code = None
-            else:
-                sku_code_raw = None
-                sku_code = None
-            
-            # 售后类型
-            aftersale_type_str = str(row.get("售后类型", "")).strip()
-            if "退货" in aftersale_type_str:
-                aftersale_type = 1
-            elif "退款" in aftersale_type_str:
-                aftersale_type = 2
-            elif "换货" in aftersale_type_str:
-                aftersale_type = 3
-            else:
-                aftersale_type = 0
-            
-            # 售后状态
-            aftersale_status_str = str(row.get("售后状态", "")).strip()
-            if any(s in aftersale_status_str for s in self.AFTERSALE_PENDING_STATUS):
-                aftersale_status = 2
-            elif "成功" in aftersale_status_str or "退款" in aftersale_status_str:
-                aftersale_status = 5
-            elif "关闭" in aftersale_status_str or "拒绝" in aftersale_status_str:
-                aftersale_status = 6
-            else:
-                aftersale_status = 1
+            sku_code = sku_codes[i] or None
+            sku_code_raw = sku_code_raws[i] if sku_code else None
             
             # 售后原因
-            reason_text = str(row.get("售后原因", "")).strip()
             reason_code = str(row.get("售后原因标签", "")).strip()
             
-            # 判断是否品质问题
-            quality_keywords = ["质量", "破损", "与描述不符", "假货", "品质"]
-            is_quality_issue = any(kw in reason_text for kw in quality_keywords)
-            
             record = {
                 "aftersale_id": aftersale_id,
                 "order_id": order_id if order_id and order_id != "nan" else None,
@@ -318,18 +528,21 @@ class ExcelImportService:
                 "sku_id": sku_code,
                 "sku_code": sku_code,
                 "sku_code_raw": sku_code_raw,
-                "aftersale_type": aftersale_type,
-                "aftersale_status": aftersale_status,
-                "aftersale_status_desc": aftersale_status_str,
-                "reason_text": reason_text,
+                "aftersale_type": aftersale_types[i],
+                "aftersale_status": aftersale_statuses[i],
+                "is_pending": pending_flags[i],
+                "aftersale_status_desc": aftersale_status_strs[i],
+                "reason_text": reason_texts[i],
                 "reason_code": reason_code if reason_code != "nan" else None,
-                "is_quality_issue": is_quality_issue,
+                "is_quality_issue": quality_flags[i],
+                "is_quality_reason": quality_reason_flags[i],
                 "apply_time": self._parse_datetime(row.get("售后申请时间")),
                 "finish_time": self._parse_datetime(row.get("售后完结时间")),
                 # 省份信息：统一先给默认值，避免批量 insert 时部分行缺少 key 导致 SQLAlchemy 报错
                 "province_id": None,
                 "province_name": None,
-                "updated_at": datetime.now(),
+                "created_at": now,
+                "updated_at": now,
             }
             records.append(record)
             
@@ -338,6 +551,12 @@ class ExcelImportService:
             
             stats["total"] += 1
         
+        records = self._dedupe_records(records, lambda r: r["aftersale_id"], "售后单")
+        return records, order_ids_needed, stats
+
+    async def _write_aftersale_batch(self, parsed: ParsedBatch) -> Dict[str, int]:
+        """写入一批已解析的售后数据"""
+        records, order_ids_needed, stats = parsed
         if not records:
             return stats
         
@@ -366,58 +585,70 @@ class ExcelImportService:
             )
             existing_ids.update(row[0] for row in exist_result.all())
 
-        # 5. 批量 upsert（避免逐条 UPDATE）
-        now = datetime.now()
-        for record in records:
-            record.setdefault("created_at", now)
-
-        # 注意：SQLite 变量上限 999，多行 VALUES 需要分片执行
-        for chunk_records in self._chunk_records_by_sql_vars(records):
-            stmt = sqlite_insert(AfterSale).values(chunk_records)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=["aftersale_id"],
-                set_={
-                    "order_id": stmt.excluded.order_id,
-                    "sku_id": stmt.excluded.sku_id,
-                    "sku_code": stmt.excluded.sku_code,
-                    "aftersale_type": stmt.excluded.aftersale_type,
-                    "aftersale_status": stmt.excluded.aftersale_status,
-                    "aftersale_status_desc": stmt.excluded.aftersale_status_desc,
-                    "reason_text": stmt.excluded.reason_text,
-                    "reason_code": stmt.excluded.reason_code,
-                    "is_quality_issue": stmt.excluded.is_quality_issue,
-                    "apply_time": stmt.excluded.apply_time,
-                    "finish_time": stmt.excluded.finish_time,
-                    "province_name": stmt.excluded.province_name,
-                    "updated_at": stmt.excluded.updated_at,
-                },
-            )
-            await self.db.execute(stmt)
+        # 5. 批量 upsert（避免逐条 UPDATE；executemany 复用同一条预编译语句）
+        stmt = sqlite_insert(AfterSale)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["aftersale_id"],
+            set_={
+                "order_id": stmt.excluded.order_id,
+                "sku_id": stmt.excluded.sku_id,
+                "sku_code": stmt.excluded.sku_code,
+                "aftersale_type": stmt.excluded.aftersale_type,
+                "aftersale_status": stmt.excluded.aftersale_status,
+                "is_pending": stmt.excluded.is_pending,
+                "aftersale_status_desc": stmt.excluded.aftersale_status_desc,
+                "reason_text": stmt.excluded.reason_text,
+                "reason_code": stmt.excluded.reason_code,
+                "is_quality_issue": stmt.excluded.is_quality_issue,
+                "is_quality_reason": stmt.excluded.is_quality_reason,
+                "apply_time": stmt.excluded.apply_time,
+                "finish_time": stmt.excluded.finish_time,
+                "province_name": stmt.excluded.province_name,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        await self.db.execute(stmt, records)
 
-        stats["created"] = sum(1 for aid in aftersale_ids if aid not in existing_ids)
-        stats["updated"] = sum(1 for aid in aftersale_ids if aid in existing_ids)
+        stats["updated"] = len(existing_ids.intersection(aftersale_ids))
+        stats["created"] = len(aftersale_ids) - stats["updated"]
         
         # 6. 退货退款类型的售后，标记对应订单为已签收
         # 原因：退货退款意味着买家已收到货并退回，可以确认已签收
-        refund_order_ids = list({
-            r["order_id"] for r in records 
-            if r["aftersale_type"] == 1 and r["order_id"]
-        })
-        if refund_order_ids:
-            # 注意：SQLite 变量上限 999，需分片更新
-            for chunk in self._chunk_list(refund_order_ids, self.SQLITE_IN_CLAUSE_CHUNK_SIZE):
-                await self.db.execute(
-                    update(Order)
-                    .where(Order.order_id.in_(chunk))
-                    .where(Order.is_signed.is_(False))
-                    .values(is_signed=True)
-                )
+        # 由 after_sales 上的触发器在 upsert 时完成（见 init_db），无需再单独 UPDATE orders
         
         # 7. 提交事务（每批次一次提交）
         await self.db.commit()
         
         return stats
     
+    def _dedupe_records(
+        self,
+        records: List[Dict[str, Any]],
+        key: Callable[[Dict[str, Any]], Hashable],
+        label: str,
+    ) -> List[Dict[str, Any]]:
+        """按主键去重（保留最后一次出现的行，dict 保持首次插入顺序）；有重复时记录告警便于排查数据质量"""
+        deduped = list({key(r): r for r in records}.values())
+        removed = len(records) - len(deduped)
+        if removed:
+            logger.warning("Excel 导入：同一批次内 %s 重复 %d 行，已按主键保留最后一条", label, removed)
+        return deduped
+
+    def _sku_code_columns(self, batch_df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+        """
+        整批解析“商家编码”列：返回 (原始编码, 净编码) 两个列表，与行一一对应
+
+        原始编码去掉制表符与首尾空白；净编码为空串表示该行没有有效编码（缺失、"nan" 或清洗后为空）。
+        """
+        sku_code_raws = self._text_column(batch_df, "商家编码").str.replace("\t", "", regex=False).str.strip()
+        return sku_code_raws.tolist(), clean_sku_code_series(sku_code_raws).tolist()
+
+    def _text_column(self, batch_df: pd.DataFrame, column: str) -> pd.Series:
+        """取文本列（与逐行 str(value).strip() 口径一致；缺列时返回空串列）"""
+        if column not in batch_df.columns:
+            return pd.Series([""] * len(batch_df), index=batch_df.index, dtype=object)
+        return batch_df[column].astype(str).str.strip()
+
     def _parse_datetime(self, value) -> Optional[datetime]:
         """解析日期时间"""
         if pd.isna(value) or value == "-" or value == "":
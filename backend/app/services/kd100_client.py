@@ -3,6 +3,7 @@
 """
 import hashlib
 import json
+from functools import lru_cache
 from typing import Dict, Any, Optional
 import httpx
 
@@ -97,8 +98,34 @@ COMPANY_CODE_MAP = {
 }
 
 
+# 全进程共享的 HTTP 客户端：复用连接池/keep-alive，避免每个 KD100Client 实例重复建连与 TLS 握手
+_shared_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_shared_client() -> httpx.AsyncClient:
+    """获取（惰性创建）共享的 httpx.AsyncClient"""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        )
+    return _shared_client
+
+
+async def close_shared_client():
+    """关闭共享的 HTTP 客户端（应用关闭时调用）"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+
 class KD100Client:
     """快递100 API 客户端"""
+
+    # 查询参数模板（与 json.dumps(..., separators=(",", ":")) 输出逐字节一致）
+    _PARAM_TEMPLATE = '{{"com":"{com}","num":"{num}"}}'
     
     def __init__(self, customer: str = None, key: str = None):
         """
@@ -111,11 +138,13 @@ class KD100Client:
         self.api_url = settings.kd100_api_url
         self.key = key or settings.kd100_key
         self.customer = customer or settings.kd100_customer
-        self._client = httpx.AsyncClient(timeout=10.0)
+        self._client = _get_shared_client()
     
-    def _get_company_code(self, company_name: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _get_company_code(company_name: str) -> str:
         """
-        根据快递公司名称获取编码
+        根据快递公司名称获取编码（按名称缓存：公司名取值很少，模糊匹配只需算一次）
         
         Args:
             company_name: 快递公司名称，如"申通快递"
@@ -135,6 +164,24 @@ class KD100Client:
         # 默认返回原名称的小写
         return company_name.lower().replace("快递", "").replace("速递", "")
     
+    @classmethod
+    def _build_param(cls, company_code: str, tracking_number: str) -> str:
+        """
+        构建查询参数 JSON 字符串
+
+        编码/单号通常是 ASCII 字母数字，无需转义，直接套模板；
+        其他情况（含引号、中文等需要 JSON 转义的字符）回退到 json.dumps。
+        """
+        if (
+            company_code.isascii() and company_code.isalnum()
+            and tracking_number.isascii() and tracking_number.isalnum()
+        ):
+            return cls._PARAM_TEMPLATE.format(com=company_code, num=tracking_number)
+        return json.dumps({
+            "com": company_code,
+            "num": tracking_number,
+        }, separators=(",", ":"))
+
     def _generate_sign(self, param: str) -> str:
         """
         生成签名
@@ -161,10 +208,7 @@ class KD100Client:
         company_code = self._get_company_code(company_name)
         
         # 构建请求参数
-        param = json.dumps({
-            "com": company_code,
-            "num": tracking_number,
-        }, separators=(",", ":"))
+        param = self._build_param(company_code, tracking_number)
         
         sign = self._generate_sign(param)
         
@@ -269,8 +313,11 @@ class KD100Client:
             }
     
     async def close(self):
-        """关闭客户端连接"""
-        await self._client.aclose()
+        """
+        关闭客户端连接
+
+        连接池为全进程共享，由应用关闭时统一调用 close_shared_client() 释放，这里无需处理。
+        """
 
 
 def parse_express_info(express_str: str) -> Dict[str, str]:
@@ -1,14 +1,19 @@
 """
 订单服务
 """
+import asyncio
+import re
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from sqlalchemy import select, and_, or_
+from operator import itemgetter
+from typing import AsyncIterator, Awaitable, List, Optional, Dict, Any, Tuple
+from sqlalchemy import select, insert, update, bindparam, and_, or_, case, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models.order import Order, OrderSku
 from app.models.after_sale import AfterSale
 from app.services.douyin_client import DouyinClient
+from app.services.stats_service import StatsService
 
 
 class OrderService:
@@ -24,13 +29,21 @@ class OrderService:
         6: "售后中",
     }
     
+    # 不需要查询物流的订单状态（已取消）：已完成但未签收的订单仍要查一次，签收状态只能由物流轨迹记录
+    NO_LOGISTICS_ORDER_STATUS = frozenset({4})
+    
     # 售后状态映射（售后未完结的状态）
-    AFTERSALE_PENDING_STATUS = [
+    AFTERSALE_PENDING_STATUS = frozenset({
         1,   # 待商家确认
         2,   # 待买家寄货
         3,   # 待商家收货
         4,   # 待商家退款
-    ]
+    })
+    
+    # 品质问题原因代码关键字（需要根据实际情况调整）
+    QUALITY_REASON_CODES = ("quality", "fake", "damaged")
+    # 关键字合并为一条预编译正则：每条原因代码单次扫描，关键字增多时也无需逐个子串查找
+    _QUALITY_RE = re.compile("|".join(map(re.escape, QUALITY_REASON_CODES)), re.IGNORECASE)
     
     # 物流状态映射
     LOGISTICS_STATUS = {
@@ -50,6 +63,35 @@ class OrderService:
         13: "已发货",
     }
     
+    # 状态码连续且范围小：按下标取描述（与上面的映射保持一致，同步热路径使用）
+    _ORDER_STATUS_ARR = ("未知", "待确认", "待发货", "已发货", "已取消", "已完成", "售后中")
+    _LOGISTICS_STATUS_ARR = (
+        "运输中", "已揽收", "终止揽收", "已签收", "已退回签收", "派送中", "退回中",
+        "转单", "取消", "已退回在途", "报废", "仓库备货中", "待取件", "已发货",
+    )
+    
+    # 详情/物流接口并发上限（逐单串行请求时整页耗时 ≈ 单次 RTT × 请求数）
+    DETAIL_FETCH_CONCURRENCY = 20
+    # 订单详情用到的字段及缺省值（顺序即解包顺序）
+    _ORDER_FIELD_DEFAULTS = (
+        ("order_status", 0),
+        ("create_time", 0),
+        ("update_time", None),
+        ("pay_time", None),
+        ("post_addr", {}),
+        ("total_amount", 0),
+        ("pay_amount", 0),
+        ("sku_order_list", []),
+    )
+    _ORDER_FIELDS = itemgetter(*(k for k, _ in _ORDER_FIELD_DEFAULTS))
+    
+    # 多行 upsert 每条语句的行数：SQLite 变量上限 999，按每行 ~22 列保守估算（40*22=880）
+    UPSERT_ROWS_PER_STMT = 40
+    # 整页均为新订单且行数达到阈值时走纯 INSERT executemany（首次回填的快路径）
+    BULK_INSERT_THRESHOLD = 100
+    # 流式查询每次从游标拉取的行数
+    STREAM_YIELD_PER = 500
+    
     def __init__(self, db: AsyncSession, douyin_client: Optional[DouyinClient] = None):
         self.db = db
         self.douyin_client = douyin_client
@@ -67,115 +109,120 @@ class OrderService:
             end_time: 结束时间
         
         Returns:
-            同步统计信息
+            同步统计信息（total = created + updated；skipped 为 updated 中 update_time 未推进、未重新拉取的订单数）
         """
         if not self.douyin_client:
             raise ValueError("未配置抖音客户端")
         
-        stats = {"total": 0, "created": 0, "updated": 0}
+        stats = {"total": 0, "created": 0, "updated": 0, "skipped": 0}
         page = 0
         size = 100
+        sem = asyncio.Semaphore(self.DETAIL_FETCH_CONCURRENCY)
+        # 时间范围在分页过程中不变，只换算一次
+        start_ts = int(start_time.timestamp())
+        end_ts = int(end_time.timestamp())
         
-        while True:
-            # 获取订单列表
-            result = await self.douyin_client.get_order_list(
-                start_time=int(start_time.timestamp()),
-                end_time=int(end_time.timestamp()),
-                page=page,
+        def fetch_list(page_no: int) -> "asyncio.Task[Dict[str, Any]]":
+            return asyncio.create_task(self.douyin_client.get_order_list(
+                start_time=start_ts,
+                end_time=end_ts,
+                page=page_no,
                 size=size,
-            )
-            
-            order_list = result.get("shop_order_list", [])
-            if not order_list:
-                break
-            
-            for order_data in order_list:
-                order_id = order_data.get("order_id", "")
+            ))
+        
+        # 下一页列表请求与本页详情拉取/写库并行：满页时立即预取下一页
+        next_list: Optional["asyncio.Task[Dict[str, Any]]"] = fetch_list(page)
+        try:
+            while True:
+                # 获取订单列表
+                result = await next_list
+                next_list = None
                 
-                # 获取订单详情
-                detail = await self.douyin_client.get_order_detail(order_id)
-                shop_order = detail.get("shop_order_detail", {})
+                order_list = result.get("shop_order_list", [])
+                if not order_list:
+                    break
+                if len(order_list) >= size:
+                    next_list = fetch_list(page + 1)
                 
-                # 查询或创建订单
-                existing = await self.db.execute(
-                    select(Order).where(Order.order_id == order_id)
+                # 整页预取已存在订单的水位信息（统计 created/updated + 跳过未变化订单），写入统一走批量 upsert
+                page_order_ids = [order_data.get("order_id", "") for order_data in order_list]
+                existing_result = await self.db.execute(
+                    select(Order.order_id, Order.update_time, Order.order_status, Order.is_signed)
+                    .where(Order.order_id.in_(page_order_ids))
                 )
-                order = existing.scalar_one_or_none()
+                existing_orders = {row[0]: row for row in existing_result.all()}
+                seen_ids = set(existing_orders)
+                # 首次回填：本页订单库里都不存在且页内不重复，则订单及其 SKU 都不会冲突
+                all_new = not seen_ids and len(set(page_order_ids)) == len(page_order_ids)
                 
-                if order:
-                    stats["updated"] += 1
-                else:
-                    order = Order(order_id=order_id)
-                    self.db.add(order)
-                    stats["created"] += 1
+                # update_time 未推进的订单不再拉详情/物流（增量同步时通常占绝大多数）
+                to_fetch = []
+                for order_data in order_list:
+                    existing = existing_orders.get(order_data.get("order_id", ""))
+                    if self._needs_update(order_data, existing):
+                        to_fetch.append((order_data, existing))
+                order_ids = [order_data.get("order_id", "") for order_data, _ in to_fetch]
+                stats["skipped"] += len(page_order_ids) - len(order_ids)
                 
-                # 更新订单信息
-                order.order_status = shop_order.get("order_status", 0)
-                order.order_status_desc = self.ORDER_STATUS.get(order.order_status, "未知")
-                order.create_time = datetime.fromtimestamp(shop_order.get("create_time", 0))
-                order.update_time = datetime.fromtimestamp(shop_order.get("update_time", 0)) if shop_order.get("update_time") else None
-                order.pay_time = datetime.fromtimestamp(shop_order.get("pay_time", 0)) if shop_order.get("pay_time") else None
+                # 并发拉取订单详情 + 物流轨迹（受信号量限流），结果按原顺序返回；终态/已签收订单不再查物流
+                fetched = await self._gather_or_cancel([
+                    self._fetch_full_order(
+                        order_data.get("order_id", ""), sem,
+                        fetch_logistics=self._needs_logistics(order_data, existing),
+                    )
+                    for order_data, existing in to_fetch
+                ])
                 
-                # 收货地址
-                post_addr = shop_order.get("post_addr", {})
-                province = post_addr.get("province", {})
-                order.province_id = province.get("id", "")
-                order.province_name = province.get("name", "")
-                city = post_addr.get("city", {})
-                order.city_name = city.get("name", "")
-                order.receiver_name = post_addr.get("receiver_name", "")
+                # total/created/updated 仍按本页列出的全部订单计（total = created + updated，与跳过前一致），
+                # 跳过的都是库里已有的订单，计入 updated，skipped 只是其中未重新拉取的部分
+                for order_id in page_order_ids:
+                    if order_id in seen_ids:
+                        stats["updated"] += 1
+                    else:
+                        seen_ids.add(order_id)
+                        stats["created"] += 1
+                    stats["total"] += 1
                 
-                # 金额
-                order.total_amount = float(shop_order.get("total_amount", 0)) / 100
-                order.pay_amount = float(shop_order.get("pay_amount", 0)) / 100
+                # 行组装是纯 CPU 变换（不访问 DB/self 状态）：物流查询异常先归一为 None（按无轨迹处理）
+                tracked_rows, untracked_rows, sku_rows = _build_order_rows(
+                    [
+                        (order_id, detail, None if isinstance(logistics, Exception) else logistics)
+                        for order_id, (detail, logistics) in zip(order_ids, fetched)
+                    ],
+                    datetime.now(),
+                )
                 
-                # 获取物流状态
+                # 每页一次提交：失败只回滚当前页，之前已提交的页保留；提交后清空 Session，内存占用与页大小成正比
                 try:
-                    logistics = await self.douyin_client.get_logistics_track(order_id)
-                    track_list = logistics.get("track_list", [])
-                    if track_list:
-                        latest_track = track_list[0]
-                        order.logistics_status = latest_track.get("state", 0)
-                        order.logistics_status_desc = self.LOGISTICS_STATUS.get(order.logistics_status, "未知")
-                        order.is_signed = order.logistics_status == 3
-                        if order.is_signed:
-                            order.sign_time = datetime.fromtimestamp(latest_track.get("time", 0))
+                    sku_keys = {(r["order_id"], r["sku_id"]) for r in sku_rows}
+                    if all_new and len(order_ids) >= self.BULK_INSERT_THRESHOLD and len(sku_keys) == len(sku_rows):
+                        await self._bulk_insert(Order, tracked_rows)
+                        await self._bulk_insert(Order, untracked_rows)
+                        await self._bulk_insert(OrderSku, sku_rows)
+                    elif all(order_id in existing_orders for order_id in order_ids):
+                        # 纯更新页：订单走 Core UPDATE executemany（不需要冲突判定），SKU 仍可能新增，继续 upsert
+                        await self._update_orders(tracked_rows, with_logistics=True)
+                        await self._update_orders(untracked_rows, with_logistics=False)
+                        await self._upsert_order_skus(sku_rows)
+                    else:
+                        await self._upsert_orders(tracked_rows, with_logistics=True)
+                        await self._upsert_orders(untracked_rows, with_logistics=False)
+                        await self._upsert_order_skus(sku_rows)
+                    await self.db.commit()
                 except Exception:
-                    # 物流查询失败不影响订单同步
-                    pass
-                
-                # 处理SKU信息
-                sku_order_list = shop_order.get("sku_order_list", [])
-                for sku_data in sku_order_list:
-                    sku_id = sku_data.get("sku_id", "")
-                    
-                    # 查询或创建订单SKU
-                    existing_sku = await self.db.execute(
-                        select(OrderSku).where(
-                            and_(OrderSku.order_id == order_id, OrderSku.sku_id == sku_id)
-                        )
-                    )
-                    order_sku = existing_sku.scalar_one_or_none()
-                    
-                    if not order_sku:
-                        order_sku = OrderSku(order_id=order_id, sku_id=sku_id)
-                        self.db.add(order_sku)
-                    
-                    order_sku.sku_code = sku_data.get("code", "")
-                    order_sku.sku_name = sku_data.get("sku_name", "")
-                    order_sku.product_id = sku_data.get("product_id", "")
-                    order_sku.product_name = sku_data.get("product_name", "")
-                    order_sku.quantity = sku_data.get("item_num", 1)
-                    order_sku.price = float(sku_data.get("price", 0)) / 100
+                    await self.db.rollback()
+                    raise
+                self.db.expunge_all()
                 
-                stats["total"] += 1
-            
-            # 检查是否还有更多数据
-            if len(order_list) < size:
-                break
-            page += 1
+                # 检查是否还有更多数据
+                if len(order_list) < size:
+                    break
+                page += 1
+        finally:
+            # 异常退出时取消尚未完成的预取请求
+            if next_list is not None and not next_list.done():
+                next_list.cancel()
         
-        await self.db.commit()
         return stats
     
     async def sync_aftersales(
@@ -199,12 +246,16 @@ class OrderService:
         stats = {"total": 0, "created": 0, "updated": 0}
         page = 0
         size = 100
+        sem = asyncio.Semaphore(self.DETAIL_FETCH_CONCURRENCY)
+        # 时间范围在分页过程中不变，只换算一次
+        start_ts = int(start_time.timestamp())
+        end_ts = int(end_time.timestamp())
         
         while True:
             # 获取售后列表
             result = await self.douyin_client.get_aftersale_list(
-                start_time=int(start_time.timestamp()),
-                end_time=int(end_time.timestamp()),
+                start_time=start_ts,
+                end_time=end_ts,
                 page=page,
                 size=size,
             )
@@ -213,92 +264,437 @@ class OrderService:
             if not aftersale_list:
                 break
             
-            for as_data in aftersale_list:
-                aftersale_id = as_data.get("aftersale_id", "")
-                
-                # 获取售后详情
-                detail = await self.douyin_client.get_aftersale_detail(aftersale_id)
-                
-                # 查询或创建售后单
-                existing = await self.db.execute(
-                    select(AfterSale).where(AfterSale.aftersale_id == aftersale_id)
-                )
-                aftersale = existing.scalar_one_or_none()
-                
-                if aftersale:
+            # 并发拉取整页售后详情（受信号量限流），结果按原顺序返回
+            details = await self._gather_or_cancel([
+                self._fetch_aftersale_detail(as_data.get("aftersale_id", ""), sem)
+                for as_data in aftersale_list
+            ])
+            
+            # 整页预取已存在的售后单号（统计 created/updated）与关联订单省份，写入统一走批量 upsert
+            aftersale_ids = [as_data.get("aftersale_id", "") for as_data in aftersale_list]
+            existing_result = await self.db.execute(
+                select(AfterSale.aftersale_id).where(AfterSale.aftersale_id.in_(aftersale_ids))
+            )
+            seen_ids = {row[0] for row in existing_result.all()}
+            related_order_ids = list({detail.get("order_id", "") for detail in details})
+            order_result = await self.db.execute(
+                select(Order.order_id, Order.province_id, Order.province_name)
+                .where(Order.order_id.in_(related_order_ids))
+            )
+            province_map = {row[0]: (row[1], row[2]) for row in order_result.all()}
+            
+            now = datetime.now()
+            aftersale_rows: List[Dict[str, Any]] = []
+            ts = self._ts
+            quality_search = self._QUALITY_RE.search
+            quality_reason_search = StatsService.QUALITY_REASON_RE.search
+            pending_status = self.AFTERSALE_PENDING_STATUS
+            
+            for aftersale_id, detail in zip(aftersale_ids, details):
+                if aftersale_id in seen_ids:
                     stats["updated"] += 1
                 else:
-                    aftersale = AfterSale(aftersale_id=aftersale_id)
-                    self.db.add(aftersale)
+                    seen_ids.add(aftersale_id)
                     stats["created"] += 1
                 
-                # 更新售后信息
-                aftersale.order_id = detail.get("order_id", "")
-                aftersale.sku_id = detail.get("sku_id", "")
-                aftersale.sku_code = detail.get("out_sku_id", "")  # 商家SKU编码
-                aftersale.aftersale_type = detail.get("aftersale_type", 0)
-                aftersale.aftersale_status = detail.get("aftersale_status", 0)
-                aftersale.reason_code = detail.get("reason_code", "")
-                aftersale.reason_text = detail.get("reason_text", "")
-                aftersale.refund_amount = float(detail.get("refund_amount", 0)) / 100
+                # 售后信息
+                order_id = detail.get("order_id", "")
+                reason_code = detail.get("reason_code", "")
+                reason_text = detail.get("reason_text", "")
                 
                 # 判断是否品质问题
-                quality_reason_codes = ["quality", "fake", "damaged"]  # 需要根据实际情况调整
-                aftersale.is_quality_issue = any(
-                    code in str(aftersale.reason_code).lower() 
-                    for code in quality_reason_codes
-                )
+                is_quality_issue = bool(quality_search(str(reason_code or "")))
                 
-                # 时间信息
-                if detail.get("apply_time"):
-                    aftersale.apply_time = datetime.fromtimestamp(detail.get("apply_time"))
-                if detail.get("finish_time"):
-                    aftersale.finish_time = datetime.fromtimestamp(detail.get("finish_time"))
+                aftersale_status = detail.get("aftersale_status", 0)
                 
-                # 关联订单的省份信息
-                order_result = await self.db.execute(
-                    select(Order).where(Order.order_id == aftersale.order_id)
-                )
-                order = order_result.scalar_one_or_none()
-                if order:
-                    aftersale.province_id = order.province_id
-                    aftersale.province_name = order.province_name
+                # 关联订单的省份信息（无关联订单时为 None，upsert 时保留原值）
+                province_id, province_name = province_map.get(order_id, (None, None))
+                
+                aftersale_rows.append({
+                    "aftersale_id": aftersale_id,
+                    "order_id": order_id,
+                    "sku_id": detail.get("sku_id", ""),
+                    "sku_code": detail.get("out_sku_id", ""),  # 商家SKU编码
+                    "aftersale_type": detail.get("aftersale_type", 0),
+                    "aftersale_status": aftersale_status,
+                    "is_pending": aftersale_status in pending_status,
+                    "reason_code": reason_code,
+                    "reason_text": reason_text,
+                    "refund_amount": int(detail.get("refund_amount", 0)),
+                    "is_quality_issue": is_quality_issue,
+                    # 品质退货统计口径（按退货原因文本）
+                    "is_quality_reason": bool(quality_reason_search(str(reason_text or ""))),
+                    # 时间信息（缺失时为 None，upsert 时保留原值）
+                    "apply_time": ts(detail.get("apply_time")),
+                    "finish_time": ts(detail.get("finish_time")),
+                    "province_id": province_id,
+                    "province_name": province_name,
+                    "created_at": now,
+                    "updated_at": now,
+                })
                 
                 stats["total"] += 1
             
+            # 每页一次提交（同 sync_orders）
+            try:
+                await self._upsert_aftersales(aftersale_rows)
+                await self.db.commit()
+            except Exception:
+                await self.db.rollback()
+                raise
+            self.db.expunge_all()
+            
             if len(aftersale_list) < size:
                 break
             page += 1
         
-        await self.db.commit()
         return stats
     
-    async def get_pending_ship_orders(self) -> List[Order]:
-        """获取待发货订单"""
-        result = await self.db.execute(
-            select(Order).where(Order.order_status == 2)
+    @staticmethod
+    def _needs_update(order_data: Dict[str, Any], existing: Optional[Any]) -> bool:
+        """
+        判断列表中的订单是否需要重新拉取详情/物流
+        
+        Args:
+            order_data: 订单列表接口返回的单条订单
+            existing: 库里已有订单的 (order_id, update_time, order_status, is_signed)，不存在为 None
+        """
+        if existing is None:
+            return True
+        list_update_time = order_data.get("update_time")
+        if not list_update_time or existing.update_time is None:
+            return True
+        # 已发货未签收：物流轨迹会变化但订单 update_time 不一定推进，仍需查询
+        if existing.order_status == 3 and not existing.is_signed:
+            return True
+        return existing.update_time < datetime.fromtimestamp(list_update_time)
+    
+    @classmethod
+    def _needs_logistics(cls, order_data: Dict[str, Any], existing: Optional[Any]) -> bool:
+        """
+        判断是否需要查询物流轨迹
+        
+        已入库且已签收、或列表里已取消的订单，轨迹不会再变，跳过查询；
+        首次入库、以及已完成但库里仍未签收的订单照常查询，保证签收状态能被记录。
+        """
+        if existing is None:
+            return True
+        if existing.is_signed:
+            return False
+        return order_data.get("order_status") not in cls.NO_LOGISTICS_ORDER_STATUS
+    
+    @staticmethod
+    def _lookup(arr: Tuple[str, ...], status: Any) -> str:
+        """按状态码下标取描述，非整数或越界时返回“未知”"""
+        if isinstance(status, int) and 0 <= status < len(arr):
+            return arr[status]
+        return "未知"
+    
+    @staticmethod
+    def _ts(value: Any) -> Optional[datetime]:
+        """秒级时间戳转 datetime；0/None/缺失返回 None"""
+        return datetime.fromtimestamp(value) if value else None
+    
+    async def _bulk_insert(self, model, rows: List[Dict[str, Any]]):
+        """
+        纯 INSERT 批量写入（executemany 复用同一条预编译语句，不受 999 变量上限影响）
+        
+        仅用于确定不会冲突的新行；调用方需保证同一批 rows 的 keys 一致。
+        """
+        if rows:
+            await self.db.execute(insert(model), rows)
+    
+    def _chunk_rows(self, rows: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """按 SQLite 单条语句变量上限（默认 999）分片多行 upsert"""
+        size = self.UPSERT_ROWS_PER_STMT
+        return [rows[i : i + size] for i in range(0, len(rows), size)]
+    
+    async def _upsert_orders(self, rows: List[Dict[str, Any]], with_logistics: bool):
+        """
+        批量 upsert 订单（按 order_id）
+        
+        Args:
+            rows: 订单行（同一批内 keys 必须一致）
+            with_logistics: 是否带物流字段；为 False 时不覆盖库里已有的物流/签收信息
+        """
+        for chunk in self._chunk_rows(rows):
+            stmt = sqlite_insert(Order).values(chunk)
+            set_ = {
+                "order_status": stmt.excluded.order_status,
+                "order_status_desc": stmt.excluded.order_status_desc,
+                "create_time": stmt.excluded.create_time,
+                "update_time": stmt.excluded.update_time,
+                "pay_time": stmt.excluded.pay_time,
+                "province_id": stmt.excluded.province_id,
+                "province_name": stmt.excluded.province_name,
+                "city_name": stmt.excluded.city_name,
+                "receiver_name": stmt.excluded.receiver_name,
+                "total_amount": stmt.excluded.total_amount,
+                "pay_amount": stmt.excluded.pay_amount,
+                "updated_at": stmt.excluded.updated_at,
+            }
+            if with_logistics:
+                set_.update({
+                    "logistics_status": stmt.excluded.logistics_status,
+                    "logistics_status_desc": stmt.excluded.logistics_status_desc,
+                    "is_signed": stmt.excluded.is_signed,
+                    # 仅签收时刷新签收时间，未签收保留原值
+                    "sign_time": case(
+                        (stmt.excluded.is_signed == True, stmt.excluded.sign_time),
+                        else_=Order.sign_time,
+                    ),
+                })
+            stmt = stmt.on_conflict_do_update(index_elements=["order_id"], set_=set_)
+            await self.db.execute(stmt)
+    
+    async def _update_orders(self, rows: List[Dict[str, Any]], with_logistics: bool):
+        """
+        批量更新已存在的订单（按 order_id，executemany 复用同一条预编译 UPDATE）
+        
+        Args:
+            rows: 订单行（同一批内 keys 必须一致，且订单均已入库）
+            with_logistics: 是否带物流字段；为 False 时不覆盖库里已有的物流/签收信息
+        """
+        if not rows:
+            return
+        table = Order.__table__
+        # 绑定参数名不能与列名相同，统一加 b_ 前缀；带上列类型，保证 DateTime 等按列类型序列化
+        fields = [k for k in rows[0] if k not in ("order_id", "created_at")]
+        values = {name: bindparam(f"b_{name}", type_=table.c[name].type) for name in fields}
+        if with_logistics:
+            # 仅签收时刷新签收时间（未签收的行 sign_time 为 None），未签收保留原值
+            values["sign_time"] = func.coalesce(values["sign_time"], table.c.sign_time)
+        stmt = update(table).where(table.c.order_id == bindparam("b_order_id")).values(values)
+        params = [{f"b_{k}": v for k, v in row.items() if k != "created_at"} for row in rows]
+        await self.db.execute(stmt, params)
+    
+    async def _upsert_order_skus(self, rows: List[Dict[str, Any]]):
+        """批量 upsert 订单SKU（冲突键为唯一索引 (order_id, sku_id)）"""
+        for chunk in self._chunk_rows(rows):
+            stmt = sqlite_insert(OrderSku).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["order_id", "sku_id"],
+                set_={
+                    "sku_code": stmt.excluded.sku_code,
+                    "sku_name": stmt.excluded.sku_name,
+                    "product_id": stmt.excluded.product_id,
+                    "product_name": stmt.excluded.product_name,
+                    "quantity": stmt.excluded.quantity,
+                    "price": stmt.excluded.price,
+                },
+            )
+            await self.db.execute(stmt)
+    
+    async def _upsert_aftersales(self, rows: List[Dict[str, Any]]):
+        """批量 upsert 售后单（按 aftersale_id）"""
+        for chunk in self._chunk_rows(rows):
+            stmt = sqlite_insert(AfterSale).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["aftersale_id"],
+                set_={
+                    "order_id": stmt.excluded.order_id,
+                    "sku_id": stmt.excluded.sku_id,
+                    "sku_code": stmt.excluded.sku_code,
+                    "aftersale_type": stmt.excluded.aftersale_type,
+                    "aftersale_status": stmt.excluded.aftersale_status,
+                    "is_pending": stmt.excluded.is_pending,
+                    "reason_code": stmt.excluded.reason_code,
+                    "reason_text": stmt.excluded.reason_text,
+                    "refund_amount": stmt.excluded.refund_amount,
+                    "is_quality_issue": stmt.excluded.is_quality_issue,
+                    "is_quality_reason": stmt.excluded.is_quality_reason,
+                    # 缺失的时间/省份不覆盖已有值
+                    "apply_time": func.coalesce(stmt.excluded.apply_time, AfterSale.apply_time),
+                    "finish_time": func.coalesce(stmt.excluded.finish_time, AfterSale.finish_time),
+                    "province_id": func.coalesce(stmt.excluded.province_id, AfterSale.province_id),
+                    "province_name": func.coalesce(stmt.excluded.province_name, AfterSale.province_name),
+                    "updated_at": stmt.excluded.updated_at,
+                },
+            )
+            await self.db.execute(stmt)
+    
+    async def _fetch_full_order(
+        self, order_id: str, sem: asyncio.Semaphore, fetch_logistics: bool = True
+    ) -> Tuple[Dict[str, Any], Any]:
+        """
+        并发获取单个订单的详情与物流轨迹
+        
+        Returns:
+            (订单详情, 物流轨迹)；物流查询失败时第二项为异常对象（不影响订单同步），
+            未查询物流时为 None，详情失败直接抛出
+        """
+        async with sem:
+            if fetch_logistics:
+                detail, logistics = await asyncio.gather(
+                    self.douyin_client.get_order_detail(order_id),
+                    self.douyin_client.get_logistics_track(order_id),
+                    return_exceptions=True,
+                )
+            else:
+                detail = await self.douyin_client.get_order_detail(order_id)
+                logistics = None
+        if isinstance(detail, BaseException):
+            raise detail
+        return detail, logistics
+    
+    @staticmethod
+    async def _gather_or_cancel(coros: List[Awaitable[Any]]) -> List[Any]:
+        """
+        并发执行并按原顺序返回结果；任一失败时取消其余仍在执行的请求并等待其结束，再抛出原始异常
+
+        直接 asyncio.gather 在失败时不会取消兄弟任务：它们会继续发请求，其异常也无人获取。
+        """
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    
+    async def _fetch_aftersale_detail(self, aftersale_id: str, sem: asyncio.Semaphore) -> Dict[str, Any]:
+        """获取单个售后单详情（受信号量限流）"""
+        async with sem:
+            return await self.douyin_client.get_aftersale_detail(aftersale_id)
+    
+    async def get_pending_ship_orders(self) -> AsyncIterator[Order]:
+        """
+        获取待发货订单（流式逐行返回，用法：async for order in svc.get_pending_ship_orders()）
+        """
+        result = await self.db.stream(
+            select(Order)
+            .where(Order.order_status == 2)
+            .execution_options(yield_per=self.STREAM_YIELD_PER)
         )
-        return result.scalars().all()
+        async for order in result.scalars():
+            yield order
     
-    async def get_signed_orders(self, days: int = 90) -> List[Order]:
-        """获取已签收订单（近N天）"""
+    async def get_signed_orders(self, days: int = 90) -> AsyncIterator[Order]:
+        """
+        获取已签收订单（近N天，流式逐行返回，用法同 get_pending_ship_orders）
+        """
         start_date = datetime.now() - timedelta(days=days)
-        result = await self.db.execute(
-            select(Order).where(
+        result = await self.db.stream(
+            select(Order)
+            .where(
                 and_(
                     Order.is_signed == True,
                     Order.sign_time >= start_date
                 )
             )
+            .execution_options(yield_per=self.STREAM_YIELD_PER)
         )
-        return result.scalars().all()
+        async for order in result.scalars():
+            yield order
     
     async def get_pending_aftersales(self) -> List[AfterSale]:
         """获取售后未完结订单"""
         result = await self.db.execute(
-            select(AfterSale).where(
-                AfterSale.aftersale_status.in_(self.AFTERSALE_PENDING_STATUS)
-            )
+            select(AfterSale).where(AfterSale.is_pending == True)
         )
         return result.scalars().all()
 
+
+def _build_order_rows(
+    items: List[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]],
+    now: datetime,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    将一页订单详情 + 物流轨迹转换为待写入的行（模块级纯函数，不依赖 Session，可整体挪到线程/进程池执行）
+    
+    Args:
+        items: [(订单号, 订单详情, 物流轨迹或 None)]；None 表示未查询/查询失败
+        now: 本页统一的 created_at/updated_at
+    
+    Returns:
+        (带物流字段的订单行, 不带物流字段的订单行, SKU 行)；
+        物流轨迹可用/不可用的订单分两组 upsert：不可用时保留库里原有的物流字段
+    """
+    tracked_rows: List[Dict[str, Any]] = []
+    untracked_rows: List[Dict[str, Any]] = []
+    sku_rows: List[Dict[str, Any]] = []
+    # 行组装是每页主要的 Python CPU 开销：热路径上用到的函数/常量先绑定为局部变量
+    fts = datetime.fromtimestamp
+    ts = OrderService._ts
+    lookup = OrderService._lookup
+    order_status_arr = OrderService._ORDER_STATUS_ARR
+    logistics_status_arr = OrderService._LOGISTICS_STATUS_ARR
+    order_fields_getter = OrderService._ORDER_FIELDS
+    order_field_defaults = OrderService._ORDER_FIELD_DEFAULTS
+    
+    for order_id, detail, logistics in items:
+        shop_order = detail.get("shop_order_detail", {})
+        # 一次取出订单详情的全部字段；缺字段时退回逐个 .get 取默认值
+        try:
+            order_fields = order_fields_getter(shop_order)
+        except KeyError:
+            order_fields = tuple(shop_order.get(k, default) for k, default in order_field_defaults)
+        (
+            order_status, create_time, update_time, pay_time,
+            post_addr, total_amount, pay_amount, sku_order_list,
+        ) = order_fields
+        
+        # 订单信息
+        province = post_addr.get("province", {})
+        city = post_addr.get("city", {})
+        order_row = {
+            "order_id": order_id,
+            "order_status": order_status,
+            "order_status_desc": lookup(order_status_arr, order_status),
+            "create_time": fts(create_time),
+            "update_time": ts(update_time),
+            "pay_time": ts(pay_time),
+            # 收货地址
+            "province_id": province.get("id", ""),
+            "province_name": province.get("name", ""),
+            "city_name": city.get("name", ""),
+            "receiver_name": post_addr.get("receiver_name", ""),
+            # 金额（平台返回即为分，按整数原样存储）
+            "total_amount": int(total_amount),
+            "pay_amount": int(pay_amount),
+            "created_at": now,
+            "updated_at": now,
+        }
+        
+        # 物流状态
+        latest_track = None
+        try:
+            # 未查询物流（终态/已签收）时 logistics 为 None，按“无轨迹”处理，保留库里原有物流字段
+            track_list = (logistics or {}).get("track_list", [])
+            if track_list:
+                latest_track = track_list[0]
+                logistics_status = latest_track.get("state", 0)
+                is_signed = logistics_status == 3
+                order_row.update({
+                    "logistics_status": logistics_status,
+                    "logistics_status_desc": lookup(logistics_status_arr, logistics_status),
+                    "is_signed": is_signed,
+                    "sign_time": fts(latest_track.get("time", 0)) if is_signed else None,
+                })
+        except Exception:
+            # 物流数据异常不影响订单同步
+            latest_track = None
+        
+        if latest_track is not None:
+            tracked_rows.append(order_row)
+        else:
+            untracked_rows.append(order_row)
+        
+        # 处理SKU信息
+        sku_rows.extend(
+            {
+                "order_id": order_id,
+                "sku_id": sku_data.get("sku_id", ""),
+                "sku_code": sku_data.get("code", ""),
+                "sku_name": sku_data.get("sku_name", ""),
+                "product_id": sku_data.get("product_id", ""),
+                "product_name": sku_data.get("product_name", ""),
+                "quantity": sku_data.get("item_num", 1),
+                "price": int(sku_data.get("price", 0)),
+                "created_at": now,
+            }
+            for sku_data in sku_order_list
+        )
+    
+    return tracked_rows, untracked_rows, sku_rows
@@ -1,16 +1,32 @@
 """
 统计服务
 """
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, date, timedelta
-from typing import List, Optional, Dict, Any
-from sqlalchemy import select, func, and_, case, or_, union
+from typing import List, Optional, Dict, Any, Tuple
+from sqlalchemy import (
+    select, insert, update, delete, func, and_, case, or_, union_all, literal, null, true, cast, bindparam, Integer, Float,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models.order import Order, OrderSku
 from app.models.after_sale import AfterSale
-from app.models.sku_stats import SkuStats
+from app.models.sku_stats import SkuStats, SkuDailyStats, SkuDailyStatsDirty
 from app.schemas.sku_stats import SkuStatsQuery, StatsSummary
 
+# 省份退货率结果缓存（进程内共享，跨 StatsService 实例生效）：看板轮询时同一区间不重复聚合。
+# 键为 (sku_code, 起始时间, 结束日期)；默认窗口的起始时间按天取整，跨天自动换键。
+# 失效：refresh_daily_stats 刷新到脏日期（有订单/售后写入）时整体清空，其余情况靠 TTL 兜底
+_ProvinceCacheKey = Tuple[Optional[str], datetime, Optional[date]]
+_province_cache: "OrderedDict[_ProvinceCacheKey, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+# 查询接口上次顺带刷新日聚合的时间（time.monotonic()，进程内共享）
+_last_read_refresh = float("-inf")
+
 
 class StatsService:
     """统计服务"""
@@ -21,6 +37,20 @@ class StatsService:
     # 最小订单数（用于计算退货率）
     MIN_ORDERS_FOR_RATE = 10
 
+    # 缓存表多行 upsert 每条语句的行数：SQLite 变量上限 999，按每行 ~18 列保守估算（50*18=900）
+    UPSERT_ROWS_PER_STMT = 50
+
+    # 全量 SKU 统计流式读取时每批的行数
+    STREAM_PARTITION_ROWS = 2000
+
+    # 省份退货率缓存：有效期（秒）与最大条目数
+    PROVINCE_CACHE_TTL = 300.0
+    PROVINCE_CACHE_MAXSIZE = 256
+
+    # 查询接口刷新日聚合的最小间隔（秒）：导入/同步/手动计算写入后都会立即刷新，
+    # 查询时只兜底处理其他写入，限频避免看板轮询时反复抢 SQLite 写锁、与导入写入排队
+    READ_REFRESH_INTERVAL = 30.0
+
     # 品质退货原因（按你勾选的四项，需兼容“/”与“／”、以及可能的空格变体）
     QUALITY_REASON_TEXTS = [
         "商品破损/包装问题",
@@ -30,6 +60,8 @@ class StatsService:
         "少件／漏发",
         "少件 / 漏发",
     ]
+    # 合并为单个正则：写入售后时一次匹配算出 is_quality_reason，统计时直接按该列过滤
+    QUALITY_REASON_RE = re.compile("|".join(map(re.escape, QUALITY_REASON_TEXTS)))
     
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -51,263 +83,259 @@ class StatsService:
         """
         now = datetime.now()
 
-        # 默认统计窗口：近90天（按 pay_time）
+        # 1. 先把有变动的支付日刷新进按日预聚合表，再对区间内的按日数据求和
+        await self.refresh_daily_stats()
+        result = await self.db.stream(
+            self._sku_totals_query(end_date is not None).execution_options(yield_per=self.STREAM_PARTITION_ROWS),
+            self._window_params(start_date, end_date),
+        )
+
+        # 2. 汇总统计结果：按批取行、逐批计算，不把全部 SKU 的原始行一次性缓冲在内存里
+        stats_list = []
+        async for partition in result.partitions():
+            stats_list.extend(self._build_sku_stats(partition, now))
+        return stats_list
+
+    @staticmethod
+    def _window_params(start_date: Optional[date], end_date: Optional[date]) -> Dict[str, str]:
+        """_sku_totals_query 的绑定参数：默认统计窗口为近90天（按 pay_time）"""
         if start_date is None:
             start_date = date.today() - timedelta(days=90)
+        params = {"start_date": start_date.isoformat()}
+        if end_date is not None:
+            params["end_date"] = end_date.isoformat()
+        return params
 
-        # 构建时间筛选条件（统一按订单支付时间 pay_time）
-        time_conditions = [
-            Order.pay_time >= datetime.combine(start_date, datetime.min.time()),
-        ]
-        if end_date:
-            time_conditions.append(Order.pay_time <= datetime.combine(end_date, datetime.max.time()))
-        
-        # 1. 单次聚合查询订单相关统计（按净编码 sku_code 聚合）
-        order_stats_query = select(
-            OrderSku.sku_code,
-            func.max(OrderSku.sku_name).label("sku_name"),
-            func.max(OrderSku.product_name).label("product_name"),
-            # 待发货订单数（按订单去重）
-            func.count(
-                func.distinct(
-                    case((Order.order_status == 2, Order.order_id), else_=None)
-                )
-            ).label("pending_ship_count"),
-            # 已签收订单数（按订单去重）
-            # 口径：is_signed=True 的订单数（不是商品件数）
-            func.count(
-                func.distinct(
-                    case((Order.is_signed == True, Order.order_id), else_=None)
-                )
-            ).label("signed_count"),
-            # 在途未签收订单数（按订单去重）
-            func.count(
-                func.distinct(
-                    case(
-                        (and_(Order.order_status == 3, Order.is_signed == False), Order.order_id),
-                        else_=None
-                    )
-                )
-            ).label("in_transit_count"),
-        ).select_from(OrderSku).join(
-            Order, OrderSku.order_id == Order.order_id
-        )
-        
-        # 应用时间筛选
-        if time_conditions:
-            order_stats_query = order_stats_query.where(and_(*time_conditions))
-        
-        order_stats_query = order_stats_query.where(OrderSku.sku_code.isnot(None))
-        order_stats_query = order_stats_query.group_by(OrderSku.sku_code)
-        
-        order_result = await self.db.execute(order_stats_query)
-        order_stats = {row.sku_code: row for row in order_result.all() if row.sku_code}
-        
-        # 2. 查询售后未完结订单数（按订单去重，按 pay_time 过滤）
-        aftersale_pending_query = select(
-            AfterSale.sku_code,
-            func.count(func.distinct(Order.order_id)).label("aftersale_pending_count"),
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).where(
-            and_(
-                AfterSale.aftersale_status.in_([2, 3]),  # 待买家寄货、待商家收货
-                AfterSale.sku_code.isnot(None),
-                *time_conditions,
-            )
-        ).group_by(AfterSale.sku_code)
-        
-        aftersale_result = await self.db.execute(aftersale_pending_query)
-        aftersale_stats = {row.sku_code: row.aftersale_pending_count for row in aftersale_result.all() if row.sku_code}
-        
-        # 3. 查询已签收退货数量
-        # 口径：订单已签收 + 售后类型为退货退款 + 按订单支付时间过滤
-        signed_return_conditions = [
-            Order.is_signed == True,
-            AfterSale.aftersale_type == 1,  # 退货退款
-            AfterSale.sku_code.isnot(None),
-        ]
-        # 应用与订单统计相同的时间筛选（按支付时间）
-        if time_conditions:
-            signed_return_conditions.extend(time_conditions)
-        
-        signed_return_query = select(
-            AfterSale.sku_code,
-            func.count(func.distinct(Order.order_id)).label("signed_return_count")  # 按订单去重
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).where(
-            and_(*signed_return_conditions)
-        ).group_by(AfterSale.sku_code)
-        
-        return_result = await self.db.execute(signed_return_query)
-        return_stats = {row.sku_code: row.signed_return_count for row in return_result.all() if row.sku_code}
-        
-        # 3.1 从 after_sales 表统计已签收订单数（用于补充 order_skus 表中缺失的 SKU）
-        # 这样 signed_count 和 signed_return_count 使用相同的数据来源，不会出现分子>分母
-        aftersale_signed_conditions = [
-            Order.is_signed == True,
-            AfterSale.sku_code.isnot(None),
-        ]
-        if time_conditions:
-            aftersale_signed_conditions.extend(time_conditions)
-        
-        aftersale_signed_query = select(
-            AfterSale.sku_code,
-            func.count(func.distinct(Order.order_id)).label("aftersale_signed_count")
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).where(
-            and_(*aftersale_signed_conditions)
-        ).group_by(AfterSale.sku_code)
-        
-        aftersale_signed_result = await self.db.execute(aftersale_signed_query)
-        aftersale_signed_stats = {row.sku_code: row.aftersale_signed_count for row in aftersale_signed_result.all() if row.sku_code}
-        
-        # 4. 品质退货订单数（按订单去重；按订单支付时间过滤）
-        quality_base_conditions = [
-            AfterSale.sku_code.isnot(None),
-            # 4类品质原因（兼容斜杠/空格变体）
-            or_(
-                AfterSale.reason_text.in_(self.QUALITY_REASON_TEXTS),
-                AfterSale.reason_text.contains("商品破损/包装问题"),
-                AfterSale.reason_text.contains("商品与描述不符"),
-                AfterSale.reason_text.contains("商品质量不好"),
-                AfterSale.reason_text.contains("少件/漏发"),
-                AfterSale.reason_text.contains("少件／漏发"),
-            ),
-        ]
-        
-        quality_return_query = select(
-            AfterSale.sku_code,
-            func.count(func.distinct(Order.order_id)).label("quality_return_count"),
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).where(and_(*quality_base_conditions))
-        
-        # 应用与订单统计相同的时间筛选（按支付时间）
-        quality_return_query = quality_return_query.where(and_(*time_conditions))
-        
-        quality_return_query = quality_return_query.group_by(AfterSale.sku_code)
-
-        quality_result = await self.db.execute(quality_return_query)
-        quality_stats = {row.sku_code: row.quality_return_count for row in quality_result.all() if row.sku_code}
+    @staticmethod
+    @lru_cache(maxsize=2)
+    def _sku_totals_query(has_end_date: bool):
+        """
+        按 SKU 汇总区间内的按日预聚合数据（未执行的查询，可再包一层做筛选/排序/分页）
 
-        # 5. 已签收订单数（用于计算品退率分母，订单数口径）
-        # 口径：按 SKU 维度对订单去重，且包含“after_sales 表中有、order_skus 表中缺失”的订单（union distinct）
-        signed_orders_from_ordersku_query = select(
-            OrderSku.sku_code,
-            func.count(func.distinct(Order.order_id)).label("signed_order_count"),
-        ).select_from(OrderSku).join(
-            Order, OrderSku.order_id == Order.order_id
-        ).where(
-            and_(
-                Order.is_signed == True,
-                OrderSku.sku_code.isnot(None),
-                *time_conditions,
-            )
-        ).group_by(OrderSku.sku_code)
-        signed_orders_from_ordersku_result = await self.db.execute(signed_orders_from_ordersku_query)
-        signed_orders_from_ordersku = {
-            row.sku_code: row.signed_order_count for row in signed_orders_from_ordersku_result.all() if row.sku_code
-        }
+        一个订单只有一个支付日，各天“按订单去重”的计数相加仍是去重口径；窗口按整天划分，与按 pay_time 过滤等价。
+        日期是绑定参数（见 _window_params），语句只依赖“是否有结束日期”，按形状缓存、只构建一次。
+        """
+        date_conditions = [SkuDailyStats.pay_date >= bindparam("start_date")]
+        if has_end_date:
+            date_conditions.append(SkuDailyStats.pay_date <= bindparam("end_date"))
 
-        signed_orders_overlap_query = select(
-            AfterSale.sku_code,
-            func.count(func.distinct(Order.order_id)).label("signed_overlap_count"),
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).join(
-            OrderSku,
-            and_(
-                OrderSku.order_id == Order.order_id,
-                OrderSku.sku_code == AfterSale.sku_code,
-            ),
+        stats_query = select(
+            SkuDailyStats.sku_code,
+            func.max(SkuDailyStats.sku_name).label("sku_name"),
+            func.max(SkuDailyStats.product_name).label("product_name"),
+            func.sum(SkuDailyStats.pending_ship_count).label("pending_ship_count"),
+            func.sum(SkuDailyStats.in_transit_count).label("in_transit_count"),
+            func.sum(SkuDailyStats.aftersale_pending_count).label("aftersale_pending_count"),
+            func.sum(SkuDailyStats.signed_return_count).label("signed_return_count"),
+            func.sum(SkuDailyStats.quality_return_count).label("quality_return_count"),
+            func.sum(SkuDailyStats.signed_count).label("signed_count"),
         ).where(
-            and_(
-                Order.is_signed == True,
-                AfterSale.sku_code.isnot(None),
-                *time_conditions,
-            )
-        ).group_by(AfterSale.sku_code)
-        signed_orders_overlap_result = await self.db.execute(signed_orders_overlap_query)
-        signed_orders_overlap = {
-            row.sku_code: row.signed_overlap_count for row in signed_orders_overlap_result.all() if row.sku_code
-        }
+            and_(*date_conditions, SkuDailyStats.sku_code.isnot(None), SkuDailyStats.sku_code != "")
+        ).group_by(SkuDailyStats.sku_code)
+        return stats_query
 
-        # union = ordersku_signed + aftersale_signed - overlap
-        signed_sku_orders: Dict[str, int] = {}
-        signed_sku_order_keys = set(signed_orders_from_ordersku.keys()) | set(aftersale_signed_stats.keys())
-        for sku_code in signed_sku_order_keys:
-            a = int(signed_orders_from_ordersku.get(sku_code, 0) or 0)
-            b = int(aftersale_signed_stats.get(sku_code, 0) or 0)
-            c = int(signed_orders_overlap.get(sku_code, 0) or 0)
-            signed_sku_orders[sku_code] = max(a + b - c, 0)
-        
-        # 7. 汇总统计结果
+    def _build_sku_stats(self, sku_stats_rows, now: datetime) -> List[Dict[str, Any]]:
+        """由 _sku_totals_query 的结果行计算派生指标（退货率、在途预估退货、缺口、品退率）"""
+        # SKU 数可达数万：行按查询列顺序直接解包，常量绑定为局部变量，计数列已是整数无需再转换
         stats_list = []
-        all_sku_codes = (
-            set(order_stats.keys())
-            | set(aftersale_stats.keys())
-            | set(return_stats.keys())
-            | set(quality_stats.keys())
-            | set(aftersale_signed_stats.keys())
-        )
-
-        for sku_code in all_sku_codes:
-            row = order_stats.get(sku_code)
-            sku_id = sku_code
-            pending_ship_count = (row.pending_ship_count or 0) if row else 0
-            in_transit_count = (row.in_transit_count or 0) if row else 0
-            aftersale_pending_count = aftersale_stats.get(sku_code, 0)
-            signed_return_count = return_stats.get(sku_code, 0)
-            quality_return_count = quality_stats.get(sku_code, 0)
-            
+        append = stats_list.append
+        min_orders_for_rate = self.MIN_ORDERS_FOR_RATE
+        default_return_rate = self.DEFAULT_RETURN_RATE
+        for (
+            sku_code, sku_name, product_name,
+            pending_ship_count, in_transit_count, aftersale_pending_count,
+            signed_return_count, quality_return_count, signed_count,
+        ) in sku_stats_rows:
+            pending_ship_count = pending_ship_count or 0
+            in_transit_count = in_transit_count or 0
+            aftersale_pending_count = aftersale_pending_count or 0
+            signed_return_count = signed_return_count or 0
+            quality_return_count = quality_return_count or 0
             # 已签收订单数：SKU 维度 union distinct(order_id)
-            signed_count = int(signed_sku_orders.get(sku_code, 0) or 0)
+            signed_count = signed_count or 0
             
             # 计算预估退货率
-            if signed_count >= self.MIN_ORDERS_FOR_RATE:
+            if signed_count >= min_orders_for_rate:
                 estimated_return_rate = signed_return_count / signed_count
             else:
-                estimated_return_rate = self.DEFAULT_RETURN_RATE
+                estimated_return_rate = default_return_rate
             
             # 计算品质退货率
             # 公式：品退率 = 品质退货数 / 所有已签收订单数
-            signed_orders_total = int(signed_sku_orders.get(sku_code, 0) or 0)
-
-            if signed_orders_total > 0:
-                quality_return_rate = quality_return_count / signed_orders_total
+            if signed_count > 0:
+                quality_return_rate = quality_return_count / signed_count
             else:
                 quality_return_rate = 0
             
             # 在途预估退货数量
             in_transit_return_estimate = int(in_transit_count * estimated_return_rate)
             
-            # 预估商品缺口
-            stock_gap = pending_ship_count - aftersale_pending_count - in_transit_return_estimate
-            
-            stats = {
-                "sku_id": sku_id,
+            append({
+                "sku_id": sku_code,
                 "sku_code": sku_code,
-                "sku_name": row.sku_name if row else None,
-                "product_name": row.product_name if row else None,
-                "pending_ship_count": int(pending_ship_count),
-                "aftersale_pending_count": int(aftersale_pending_count),
-                "signed_count": int(signed_count),
-                "signed_return_count": int(signed_return_count),
+                "sku_name": sku_name,
+                "product_name": product_name,
+                "pending_ship_count": pending_ship_count,
+                "aftersale_pending_count": aftersale_pending_count,
+                "signed_count": signed_count,
+                "signed_return_count": signed_return_count,
                 "estimated_return_rate": round(estimated_return_rate, 4),
-                "in_transit_count": int(in_transit_count),
-                "in_transit_return_estimate": int(in_transit_return_estimate),
-                "stock_gap": int(stock_gap),
-                "quality_return_count": int(quality_return_count),
+                "in_transit_count": in_transit_count,
+                "in_transit_return_estimate": in_transit_return_estimate,
+                # 预估商品缺口
+                "stock_gap": pending_ship_count - aftersale_pending_count - in_transit_return_estimate,
+                "quality_return_count": quality_return_count,
                 "quality_return_rate": round(quality_return_rate, 4),
                 "last_calculated_at": now,
-            }
-            stats_list.append(stats)
+            })
         
         return stats_list
     
+    async def refresh_daily_stats(self) -> int:
+        """
+        增量刷新 SKU 按日预聚合表（sku_daily_stats）
+        
+        只重算触发器标记为“有变动”的支付日（sku_daily_stats_dirty）：订单明细（order_skus）与售后（after_sales）
+        两个来源按 (sku_code, order_id) UNION ALL，再按 (sku_code, 支付日) 一次 GROUP BY，用条件 COUNT(DISTINCT)
+        得到全部口径。没有变动时直接返回，不占用写锁。
+        
+        Returns:
+            刷新的天数
+        """
+        dirty_count, first_date, last_date = (
+            await self.db.execute(
+                select(
+                    func.count(),
+                    func.min(SkuDailyStatsDirty.pay_date),
+                    func.max(SkuDailyStatsDirty.pay_date),
+                )
+            )
+        ).one()
+        if not dirty_count:
+            return 0
+
+        # 上面的读不持写锁，之后到 DELETE 取得写锁之间其他连接仍可能提交新的脏日期：
+        # 只处理 [first_date, last_date] 内的脏日期（取得写锁时已提交的都会被重算），
+        # 区间外新增的保留在脏表里，下次刷新再处理
+        dirty_in_range = SkuDailyStatsDirty.pay_date.between(first_date, last_date)
+        dirty_dates = select(SkuDailyStatsDirty.pay_date).where(dirty_in_range)
+        pay_date = func.date(Order.pay_time)
+        # 先用 [最早脏日期, 最晚脏日期+1天) 的 pay_time 区间走覆盖索引 ix_orders_pay_time_cover，
+        # 再按脏日期精确过滤；只按 date(pay_time) 过滤会全表扫描 orders
+        window_start = datetime.strptime(first_date, "%Y-%m-%d")
+        window_end = datetime.strptime(last_date, "%Y-%m-%d") + timedelta(days=1)
+        pay_window = select(
+            Order.order_id,
+            Order.order_status,
+            Order.is_signed,
+            pay_date.label("pay_date"),
+        ).where(
+            and_(
+                Order.pay_time >= window_start,
+                Order.pay_time < window_end,
+                pay_date.in_(dirty_dates),
+            )
+        ).cte("pay_window")
+
+        # 品质退货：4类品质原因（写入时已按 QUALITY_REASON_TEXTS 预先计算）
+        is_quality = AfterSale.is_quality_reason == True
+
+        # source=0：订单明细；名称与待发货/在途口径只取自订单明细
+        ordersku_rows = select(
+            OrderSku.sku_code.label("sku_code"),
+            pay_window.c.order_id.label("order_id"),
+            pay_window.c.order_status.label("order_status"),
+            pay_window.c.is_signed.label("is_signed"),
+            pay_window.c.pay_date.label("pay_date"),
+            literal(0).label("source"),
+            OrderSku.sku_name.label("sku_name"),
+            OrderSku.product_name.label("product_name"),
+            null().label("aftersale_status"),
+            null().label("aftersale_type"),
+            literal(False).label("is_quality"),
+        ).select_from(OrderSku).join(
+            pay_window, OrderSku.order_id == pay_window.c.order_id
+        ).where(OrderSku.sku_code.isnot(None))
+
+        # source=1：售后；只取会计入某项口径的行（售后未完结/已签收/品质原因），
+        # 保证结果中的 SKU 集合与各口径的并集一致
+        aftersale_rows = select(
+            AfterSale.sku_code.label("sku_code"),
+            pay_window.c.order_id.label("order_id"),
+            pay_window.c.order_status.label("order_status"),
+            pay_window.c.is_signed.label("is_signed"),
+            pay_window.c.pay_date.label("pay_date"),
+            literal(1).label("source"),
+            null().label("sku_name"),
+            null().label("product_name"),
+            AfterSale.aftersale_status.label("aftersale_status"),
+            AfterSale.aftersale_type.label("aftersale_type"),
+            is_quality.label("is_quality"),
+        ).select_from(AfterSale).join(
+            pay_window, AfterSale.order_id == pay_window.c.order_id
+        ).where(
+            and_(
+                AfterSale.sku_code.isnot(None),
+                or_(
+                    AfterSale.aftersale_status.in_([2, 3]),
+                    pay_window.c.is_signed == True,
+                    is_quality,
+                ),
+            )
+        )
+
+        sku_rows = union_all(ordersku_rows, aftersale_rows).subquery("sku_rows")
+        c = sku_rows.c
+
+        def count_orders(condition):
+            """满足条件的订单数（按订单去重）"""
+            return func.count(func.distinct(case((condition, c.order_id), else_=None)))
+
+        daily_query = select(
+            c.sku_code,
+            c.pay_date,
+            func.max(c.sku_name).label("sku_name"),
+            func.max(c.product_name).label("product_name"),
+            # 待发货订单数、在途未签收订单数：只取订单明细行（同步的明细按 sku_id 唯一，同一订单可能有多行同编码，需去重）
+            count_orders(and_(c.source == 0, c.order_status == 2)).label("pending_ship_count"),
+            count_orders(and_(c.source == 0, c.order_status == 3, c.is_signed == False)).label("in_transit_count"),
+            # 售后未完结订单数（待买家寄货、待商家收货）
+            count_orders(and_(c.source == 1, c.aftersale_status.in_([2, 3]))).label("aftersale_pending_count"),
+            # 已签收退货数：订单已签收 + 售后类型为退货退款
+            count_orders(and_(c.source == 1, c.is_signed == True, c.aftersale_type == 1)).label("signed_return_count"),
+            # 品质退货订单数
+            count_orders(and_(c.source == 1, c.is_quality == True)).label("quality_return_count"),
+            # 已签收订单数：订单明细与售后两个来源 union distinct(order_id)，
+            # 包含“after_sales 表中有、order_skus 表中缺失”的订单，签收数与退货数同源，不会出现分子>分母
+            count_orders(c.is_signed == True).label("signed_count"),
+        ).group_by(c.sku_code, c.pay_date)
+
+        daily_columns = [
+            "sku_code", "pay_date", "sku_name", "product_name",
+            "pending_ship_count", "in_transit_count", "aftersale_pending_count",
+            "signed_return_count", "quality_return_count", "signed_count",
+        ]
+        try:
+            await self.db.execute(delete(SkuDailyStats).where(SkuDailyStats.pay_date.in_(dirty_dates)))
+            await self.db.execute(insert(SkuDailyStats).from_select(daily_columns, daily_query))
+            # 已持有写锁，区间内不会再有新的脏日期写入；只删本次重算过的区间
+            await self.db.execute(delete(SkuDailyStatsDirty).where(dirty_in_range))
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        _province_cache.clear()
+        return dirty_count
+    
+    async def _refresh_daily_stats_for_read(self) -> None:
+        """查询接口前的日聚合刷新：距上次不足 READ_REFRESH_INTERVAL 秒时跳过"""
+        global _last_read_refresh
+        now = time.monotonic()
+        if now - _last_read_refresh < self.READ_REFRESH_INTERVAL:
+            return
+        _last_read_refresh = now
+        await self.refresh_daily_stats()
+    
     async def save_sku_stats(self, stats_list: List[Dict[str, Any]]) -> int:
         """
         保存SKU统计数据到缓存表
@@ -318,64 +346,82 @@ class StatsService:
         Returns:
             保存的记录数
         """
-        count = 0
+        if not stats_list:
+            await self.db.commit()
+            return 0
+
         now = datetime.now()
-        
-        for stats in stats_list:
-            sku_code = stats["sku_code"]
-            
-            # 查询是否存在该 SKU 的记录
-            existing = await self.db.execute(
-                select(SkuStats).where(SkuStats.sku_code == sku_code)
-            )
-            sku_stats = existing.scalar_one_or_none()
-            
-            if sku_stats:
-                # 更新：若未手动修改，则使用本次计算值；若手动修改则保留原值
-                if not sku_stats.is_rate_manual:
-                    sku_stats.estimated_return_rate = stats["estimated_return_rate"]
-            else:
-                sku_stats = SkuStats(
-                    # 统一口径：缓存表的 sku_id 也使用净编码（避免依赖平台 sku_id）
-                    sku_id=stats["sku_code"],
-                    sku_code=sku_code,
-                )
+        rows = [
+            {
+                # 统一口径：缓存表的 sku_id 也使用净编码（避免依赖平台 sku_id）
+                "sku_id": stats["sku_code"],
+                "sku_code": stats["sku_code"],
+                "sku_name": stats["sku_name"],
+                "product_name": stats["product_name"],
+                "pending_ship_count": stats["pending_ship_count"],
+                "aftersale_pending_count": stats["aftersale_pending_count"],
+                "signed_count": stats["signed_count"],
+                "signed_return_count": stats["signed_return_count"],
                 # 新建记录：写入本次计算的退货率（否则会停留在模型 default=0.3）
-                sku_stats.estimated_return_rate = stats["estimated_return_rate"]
-                self.db.add(sku_stats)
-            
-            # 选择最终生效的退货率：
-            # - 手动修改：保留 sku_stats.estimated_return_rate
-            # - 非手动：使用本次计算的 stats["estimated_return_rate"]
-            final_return_rate = (
-                float(sku_stats.estimated_return_rate)
-                if sku_stats.is_rate_manual
-                else float(stats["estimated_return_rate"])
-            )
+                "estimated_return_rate": stats["estimated_return_rate"],
+                "is_rate_manual": False,
+                "in_transit_count": stats["in_transit_count"],
+                "in_transit_return_estimate": int(stats["in_transit_count"] * float(stats["estimated_return_rate"])),
+                "stock_gap": (
+                    int(stats["pending_ship_count"])
+                    - int(stats["aftersale_pending_count"])
+                    - int(stats["in_transit_count"] * float(stats["estimated_return_rate"]))
+                ),
+                "quality_return_count": stats.get("quality_return_count", 0),
+                "quality_return_rate": stats.get("quality_return_rate", 0),
+                "last_calculated_at": now,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for stats in stats_list
+        ]
 
-            # 更新其他字段
-            sku_stats.sku_name = stats["sku_name"]
-            sku_stats.product_name = stats["product_name"]
-            sku_stats.pending_ship_count = stats["pending_ship_count"]
-            sku_stats.aftersale_pending_count = stats["aftersale_pending_count"]
-            sku_stats.signed_count = stats["signed_count"]
-            sku_stats.signed_return_count = stats["signed_return_count"]
-            sku_stats.in_transit_count = stats["in_transit_count"]
-            # 派生字段统一用 final_return_rate 计算，确保与退货率一致且不破坏手动修改
-            sku_stats.in_transit_return_estimate = int(sku_stats.in_transit_count * final_return_rate)
-            sku_stats.stock_gap = (
-                int(sku_stats.pending_ship_count)
-                - int(sku_stats.aftersale_pending_count)
-                - int(sku_stats.in_transit_return_estimate)
+        # 单条 INSERT ... ON CONFLICT(sku_code) DO UPDATE 批量写入，替代逐条 SELECT + UPDATE/INSERT
+        # 选择最终生效的退货率（在 SQL 中按已有记录判断，无需预先查询）：
+        # - 手动修改：保留 sku_stats.estimated_return_rate
+        # - 非手动：使用本次计算的 excluded.estimated_return_rate
+        # 派生字段统一用最终退货率计算，确保与退货率一致且不破坏手动修改
+        table = SkuStats.__table__
+        for i in range(0, len(rows), self.UPSERT_ROWS_PER_STMT):
+            stmt = sqlite_insert(SkuStats).values(rows[i : i + self.UPSERT_ROWS_PER_STMT])
+            excluded = stmt.excluded
+            final_return_rate = case(
+                (table.c.is_rate_manual == True, table.c.estimated_return_rate),
+                else_=excluded.estimated_return_rate,
             )
-            sku_stats.quality_return_count = stats.get("quality_return_count", 0)
-            sku_stats.quality_return_rate = stats.get("quality_return_rate", 0)
-            sku_stats.last_calculated_at = now
-            
-            count += 1
+            in_transit_return_estimate = cast(excluded.in_transit_count * final_return_rate, Integer)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["sku_code"],
+                set_={
+                    "estimated_return_rate": final_return_rate,
+                    "sku_name": excluded.sku_name,
+                    "product_name": excluded.product_name,
+                    "pending_ship_count": excluded.pending_ship_count,
+                    "aftersale_pending_count": excluded.aftersale_pending_count,
+                    "signed_count": excluded.signed_count,
+                    "signed_return_count": excluded.signed_return_count,
+                    "in_transit_count": excluded.in_transit_count,
+                    "in_transit_return_estimate": in_transit_return_estimate,
+                    "stock_gap": (
+                        excluded.pending_ship_count
+                        - excluded.aftersale_pending_count
+                        - in_transit_return_estimate
+                    ),
+                    "quality_return_count": excluded.quality_return_count,
+                    "quality_return_rate": excluded.quality_return_rate,
+                    "last_calculated_at": excluded.last_calculated_at,
+                    "updated_at": excluded.updated_at,
+                },
+            )
+            await self.db.execute(stmt)
         
         await self.db.commit()
-        return count
+        return len(rows)
     
     async def get_sku_stats(self, query: SkuStatsQuery) -> Dict[str, Any]:
         """
@@ -439,39 +485,89 @@ class StatsService:
         }
     
     async def _get_realtime_stats(self, query: SkuStatsQuery) -> Dict[str, Any]:
-        """实时计算统计数据（有时间筛选时使用）"""
-        # 实时计算
-        stats_list = await self.calculate_sku_stats(
-            start_date=query.start_date,
-            end_date=query.end_date
+        """
+        实时计算统计数据（有时间筛选时使用）
+
+        筛选/排序/分页都在 SQL 中完成，只对当前页的 SKU 计算派生指标，不必把全部 SKU 拉到 Python 里排序。
+        """
+        await self._refresh_daily_stats_for_read()
+        page_stmt, count_stmt = self._realtime_queries(
+            query.end_date is not None,
+            bool(query.sku_code),
+            query.sort_by,
+            query.sort_order == "desc",
+            bool(query.top_n),
         )
-        
-        # SKU 搜索筛选
+
+        params = self._window_params(query.start_date, query.end_date)
         if query.sku_code:
-            stats_list = [
-                s for s in stats_list 
-                if query.sku_code.lower() in (s["sku_code"] or "").lower()
-            ]
-        
-        # 排序
-        sort_key = query.sort_by
-        reverse = query.sort_order == "desc"
-        stats_list.sort(key=lambda x: x.get(sort_key, 0) or 0, reverse=reverse)
-        
-        total = len(stats_list)
-        
+            # 与 icontains(autoescape=True) 相同的转义：以 / 为转义符，模式里的 / % _ 按字面匹配
+            params["sku_code_search"] = (
+                query.sku_code.replace("/", "//").replace("%", "/%").replace("_", "/_")
+            )
+
         # Top N 或分页
         if query.top_n:
-            items = stats_list[:query.top_n]
+            page_params = {**params, "limit": query.top_n}
         else:
-            offset = (query.page - 1) * query.page_size
-            items = stats_list[offset:offset + query.page_size]
-        
+            page_params = {**params, "limit": query.page_size, "offset": (query.page - 1) * query.page_size}
+
+        result = await self.db.execute(page_stmt, page_params)
+        items = self._build_sku_stats(result.all(), datetime.now())
+
+        total_result = await self.db.execute(count_stmt, params)
+        total = total_result.scalar() or 0
+
         return {
             "total": total,
             "items": items,
             "is_realtime": True,
         }
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _realtime_queries(cls, has_end_date: bool, has_search: bool, sort_by: str, descending: bool, is_top_n: bool):
+        """
+        实时统计的分页查询与计数查询（日期、搜索词、limit/offset 均为绑定参数）
+
+        语句结构只取决于这几个开关和排序字段，按形状缓存：看板轮询时不必每次重新构建表达式树和计算缓存键。
+        """
+        totals = cls._sku_totals_query(has_end_date).subquery("sku_totals")
+        c = totals.c
+
+        # SKU 搜索（不区分大小写）
+        conditions = []
+        if has_search:
+            conditions.append(c.sku_code.icontains(bindparam("sku_code_search"), escape="/"))
+
+        # 派生指标的排序表达式与 _build_sku_stats 的计算口径一致
+        estimated_return_rate = case(
+            (c.signed_count >= cls.MIN_ORDERS_FOR_RATE, cast(c.signed_return_count, Float) / c.signed_count),
+            else_=cls.DEFAULT_RETURN_RATE,
+        )
+        in_transit_return_estimate = cast(c.in_transit_count * estimated_return_rate, Integer)
+        sort_columns = {
+            **{column.name: column for column in c},
+            "sku_id": c.sku_code,
+            "estimated_return_rate": func.round(estimated_return_rate, 4),
+            "in_transit_return_estimate": in_transit_return_estimate,
+            "stock_gap": c.pending_ship_count - c.aftersale_pending_count - in_transit_return_estimate,
+            "quality_return_rate": func.round(
+                case((c.signed_count > 0, cast(c.quality_return_count, Float) / c.signed_count), else_=0), 4
+            ),
+        }
+
+        page_stmt = select(totals).where(*conditions)
+        # 排序（同值按 SKU 编码升序，与原先按编码聚合后稳定排序的结果一致）；未知字段不排序
+        sort_column = sort_columns.get(sort_by)
+        if sort_column is not None:
+            page_stmt = page_stmt.order_by(sort_column.desc() if descending else sort_column.asc())
+        page_stmt = page_stmt.order_by(c.sku_code).limit(bindparam("limit"))
+        if not is_top_n:
+            page_stmt = page_stmt.offset(bindparam("offset"))
+
+        count_stmt = select(func.count()).select_from(totals).where(*conditions)
+        return page_stmt, count_stmt
     
     async def update_return_rate(
         self, 
@@ -488,27 +584,27 @@ class StatsService:
         Returns:
             是否更新成功
         """
+        # 单条 UPDATE 在 SQL 里重算相关指标，不把整行加载成 ORM 对象再逐个属性赋值；
+        # SET 中的列引用取更新前的值，缺口直接用新的在途预估退货表达式计算
+        in_transit_return_estimate = cast(SkuStats.in_transit_count * return_rate, Integer)
         result = await self.db.execute(
-            select(SkuStats).where(SkuStats.sku_code == sku_code)
+            update(SkuStats)
+            .where(SkuStats.sku_code == sku_code)
+            .values(
+                estimated_return_rate=return_rate,
+                is_rate_manual=True,
+                in_transit_return_estimate=in_transit_return_estimate,
+                stock_gap=(
+                    SkuStats.pending_ship_count
+                    - SkuStats.aftersale_pending_count
+                    - in_transit_return_estimate
+                ),
+            )
+            .execution_options(synchronize_session=False)
         )
-        sku_stats = result.scalar_one_or_none()
-        
-        if not sku_stats:
+        if not result.rowcount:
             return False
         
-        sku_stats.estimated_return_rate = return_rate
-        sku_stats.is_rate_manual = True
-        
-        # 重新计算相关指标
-        sku_stats.in_transit_return_estimate = int(
-            sku_stats.in_transit_count * return_rate
-        )
-        sku_stats.stock_gap = (
-            sku_stats.pending_ship_count 
-            - sku_stats.aftersale_pending_count 
-            - sku_stats.in_transit_return_estimate
-        )
-        
         await self.db.commit()
         return True
     
@@ -527,7 +623,7 @@ class StatsService:
             end_date: 结束日期（支付时间，可选）
         
         Returns:
-            省份退货率统计
+            省份退货率统计（来自缓存时与其他调用方共享，调用方只读不改）
         """
         # 确定时间范围：按订单支付时间 pay_time；不传则默认近90天
         if start_date:
@@ -540,28 +636,43 @@ class StatsService:
         else:
             end_dt = datetime.now()
 
+        # 先处理待刷新的支付日（限频）：有新写入时顺带清空缓存
+        await self._refresh_daily_stats_for_read()
+        key = (sku_code, start_dt, end_date)
+        hit = _province_cache.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            _province_cache.move_to_end(key)
+            return hit[1]
+
         # 口径对齐（与 SKU 统计一致）：
         # - 订单数：已签收订单（Order.is_signed=True），按 pay_time 窗口过滤；
         #          union distinct(order_id) 融合 ordersku 与 aftersale 两个来源，避免缺失且去重；
         #          仅统计 sku_code 非空的订单（与 SKU 维度统计一致）。
         # - 退货数：已签收 + 退货退款(aftersale_type=1) + sku_code 非空，count(distinct order_id)，按 pay_time 窗口过滤。
 
-        # 1) 省份订单数：union distinct(province_name, order_id)
+        # 支付窗口内的已签收订单：两个来源共用同一份窗口定义（普通子查询，SQLite 会逐处展开，各自走 pay_time 覆盖索引）
+        signed_window = select(
+            Order.order_id,
+            Order.province_name,
+        ).where(
+            and_(
+                Order.is_signed == True,
+                Order.pay_time >= start_dt,
+                Order.pay_time <= end_dt,
+            )
+        ).subquery("signed_window")
+
+        # 两个来源按 (province_name, order_id, is_return) UNION ALL，一次 GROUP BY 同时得到订单数与退货数；
+        # 退货行是售后来源的子集，退货省份必然也有订单数，不需要再与订单数结果做外连接
         signed_orders_from_ordersku_conditions = [
-            Order.is_signed == True,
-            Order.pay_time >= start_dt,
-            Order.pay_time <= end_dt,
-            Order.province_name.isnot(None),
-            Order.province_name != "",
+            signed_window.c.province_name.isnot(None),
+            signed_window.c.province_name != "",
             OrderSku.sku_code.isnot(None),
         ]
         if sku_code:
             signed_orders_from_ordersku_conditions.append(OrderSku.sku_code == sku_code)
 
         signed_orders_from_aftersale_conditions = [
-            Order.is_signed == True,
-            Order.pay_time >= start_dt,
-            Order.pay_time <= end_dt,
             AfterSale.province_name.isnot(None),
             AfterSale.province_name != "",
             AfterSale.sku_code.isnot(None),
@@ -570,61 +681,41 @@ class StatsService:
             signed_orders_from_aftersale_conditions.append(AfterSale.sku_code == sku_code)
 
         signed_orders_from_ordersku = select(
-            Order.province_name.label("province_name"),
-            Order.order_id.label("order_id"),
-        ).select_from(Order).join(
-            OrderSku, Order.order_id == OrderSku.order_id
+            signed_window.c.province_name.label("province_name"),
+            signed_window.c.order_id.label("order_id"),
+            literal(False).label("is_return"),
+        ).select_from(signed_window).join(
+            OrderSku, signed_window.c.order_id == OrderSku.order_id
         ).where(and_(*signed_orders_from_ordersku_conditions))
 
         signed_orders_from_aftersale = select(
             AfterSale.province_name.label("province_name"),
-            Order.order_id.label("order_id"),
+            signed_window.c.order_id.label("order_id"),
+            (AfterSale.aftersale_type == 1).label("is_return"),  # 退货退款
         ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
+            signed_window, AfterSale.order_id == signed_window.c.order_id
         ).where(and_(*signed_orders_from_aftersale_conditions))
 
-        signed_orders_union = union(
+        signed_orders = union_all(
             signed_orders_from_ordersku,
             signed_orders_from_aftersale,
-        ).subquery("signed_orders_union")
-
-        order_stmt = select(
-            signed_orders_union.c.province_name,
-            func.count(func.distinct(signed_orders_union.c.order_id)).label("order_count"),
-        ).group_by(signed_orders_union.c.province_name)
-
-        order_result = await self.db.execute(order_stmt)
-        order_stats = {row.province_name: int(row.order_count or 0) for row in order_result.all()}
-
-        # 2) 省份退货数：已签收 + 退货退款 + sku_code非空，distinct order_id
-        return_conditions = [
-            Order.is_signed == True,
-            Order.pay_time >= start_dt,
-            Order.pay_time <= end_dt,
-            AfterSale.aftersale_type == 1,  # 退货退款
-            AfterSale.province_name.isnot(None),
-            AfterSale.province_name != "",
-            AfterSale.sku_code.isnot(None),
-        ]
-        if sku_code:
-            return_conditions.append(AfterSale.sku_code == sku_code)
+        ).subquery("signed_orders")
 
-        return_stmt = select(
-            AfterSale.province_name,
-            func.count(func.distinct(Order.order_id)).label("return_count"),
-        ).select_from(AfterSale).join(
-            Order, AfterSale.order_id == Order.order_id
-        ).where(and_(*return_conditions)).group_by(AfterSale.province_name)
+        province_stmt = select(
+            signed_orders.c.province_name,
+            # 订单数：两个来源 union distinct(order_id)
+            func.count(func.distinct(signed_orders.c.order_id)).label("order_count"),
+            # 退货数：已签收 + 退货退款 + sku_code非空，distinct order_id
+            func.count(
+                func.distinct(case((signed_orders.c.is_return == True, signed_orders.c.order_id), else_=None))
+            ).label("return_count"),
+        ).group_by(signed_orders.c.province_name)
+
+        province_result = await self.db.execute(province_stmt)
 
-        return_result = await self.db.execute(return_stmt)
-        return_stats = {row.province_name: int(row.return_count or 0) for row in return_result.all()}
-        
         # 计算退货率
         province_stats = []
-        all_provinces = set(order_stats.keys()) | set(return_stats.keys())
-        for province in all_provinces:
-            order_count = int(order_stats.get(province, 0) or 0)
-            return_count = int(return_stats.get(province, 0) or 0)
+        for province, order_count, return_count in province_result.all():
             return_rate = (return_count / order_count) if order_count > 0 else 0
 
             province_stats.append(
@@ -638,7 +729,11 @@ class StatsService:
         
         # 按退货率排序
         province_stats.sort(key=lambda x: x["return_rate"], reverse=True)
-        
+
+        _province_cache[key] = (time.monotonic() + self.PROVINCE_CACHE_TTL, province_stats)
+        _province_cache.move_to_end(key)
+        while len(_province_cache) > self.PROVINCE_CACHE_MAXSIZE:
+            _province_cache.popitem(last=False)
         return province_stats
     
     async def get_summary(self) -> StatsSummary:
@@ -648,49 +743,49 @@ class StatsService:
         Returns:
             汇总数据
         """
-        # 订单总数
-        total_orders_result = await self.db.execute(
-            select(func.count()).select_from(Order)
-        )
-        total_orders = total_orders_result.scalar() or 0
-        
-        # 待发货订单数
-        pending_ship_result = await self.db.execute(
-            select(func.count()).select_from(Order).where(Order.order_status == 2)
-        )
-        pending_ship_orders = pending_ship_result.scalar() or 0
+        # 单条语句取齐全部汇总值：三张表各聚合成一行再拼接，订单表只扫描一遍
+        order_summary = select(
+            # 订单总数
+            func.count().label("total_orders"),
+            # 待发货订单数
+            func.count(case((Order.order_status == 2, 1), else_=None)).label("pending_ship_orders"),
+            # 已签收订单数
+            func.count(case((Order.is_signed == True, 1), else_=None)).label("signed_orders"),
+            # 最后导入时间（取订单表最大更新时间）
+            func.max(Order.updated_at).label("last_import_time"),
+        ).subquery("order_summary")
         
         # 售后未完结数
-        aftersale_pending_result = await self.db.execute(
-            select(func.count()).select_from(AfterSale).where(
-                AfterSale.aftersale_status.in_([2, 3])
-            )
-        )
-        aftersale_pending_count = aftersale_pending_result.scalar() or 0
+        aftersale_summary = select(
+            func.count().label("aftersale_pending_count"),
+        ).where(AfterSale.aftersale_status.in_([2, 3])).subquery("aftersale_summary")
         
-        # 已签收订单数
-        signed_result = await self.db.execute(
-            select(func.count()).select_from(Order).where(Order.is_signed == True)
-        )
-        signed_orders = signed_result.scalar() or 0
+        # 总商品缺口、最后计算时间（从缓存表汇总）
+        sku_summary = select(
+            func.sum(SkuStats.stock_gap).label("total_stock_gap"),
+            func.max(SkuStats.last_calculated_at).label("last_calculated_at"),
+        ).subquery("sku_summary")
         
-        # 总商品缺口（从缓存表汇总）
-        stock_gap_result = await self.db.execute(
-            select(func.sum(SkuStats.stock_gap)).select_from(SkuStats)
-        )
-        total_stock_gap = stock_gap_result.scalar() or 0
+        # 待刷新的日聚合天数（导入后尚未重新计算的支付日期，用于判断统计是否过期）
+        dirty_summary = select(
+            func.count().label("pending_refresh_days"),
+        ).select_from(SkuDailyStatsDirty).subquery("dirty_summary")
         
-        # 最后计算时间
-        last_calc_result = await self.db.execute(
-            select(func.max(SkuStats.last_calculated_at)).select_from(SkuStats)
-        )
-        last_calculated_at = last_calc_result.scalar()
-        
-        # 最后导入时间（取订单表最大更新时间）
-        last_import_result = await self.db.execute(
-            select(func.max(Order.updated_at)).select_from(Order)
+        result = await self.db.execute(
+            select(order_summary, aftersale_summary, sku_summary, dirty_summary)
+            .select_from(order_summary)
+            .join(aftersale_summary, true())
+            .join(sku_summary, true())
+            .join(dirty_summary, true())
         )
-        last_import_time = last_import_result.scalar()
+        row = result.one()
+        total_orders = row.total_orders or 0
+        pending_ship_orders = row.pending_ship_orders or 0
+        aftersale_pending_count = row.aftersale_pending_count or 0
+        signed_orders = row.signed_orders or 0
+        total_stock_gap = row.total_stock_gap or 0
+        last_calculated_at = row.last_calculated_at
+        last_import_time = row.last_import_time
         
         return StatsSummary(
             total_orders=total_orders,
@@ -700,5 +795,6 @@ class StatsService:
             total_stock_gap=int(total_stock_gap),
             last_import_time=last_import_time,
             last_calculated_at=last_calculated_at,
+            pending_refresh_days=row.pending_refresh_days or 0,
         )
 
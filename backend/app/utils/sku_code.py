@@ -7,10 +7,13 @@ SKU 编码处理工具
 from __future__ import annotations
 
 import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 _PAREN_CONTENT_RE = re.compile(r"[（(][^）)]*[）)]")
-_WHITESPACE_RE = re.compile(r"\s+")
 
 
 def clean_sku_code(raw: str | None) -> str:
@@ -29,8 +32,20 @@ def clean_sku_code(raw: str | None) -> str:
     if not s or s == "nan":
         return ""
 
-    s = _PAREN_CONTENT_RE.sub("", s)
-    s = _WHITESPACE_RE.sub(" ", s).strip()
-    return s
+    # 绝大多数编码不含括号：先用子串判断跳过正则扫描
+    if "(" in s or "（" in s:
+        s = _PAREN_CONTENT_RE.sub("", s)
+    # split() 与正则 \s 的空白定义一致（均为 str.isspace），一次 C 级扫描完成“压缩空白 + 去首尾空白”
+    return " ".join(s.split())
+
 
+def clean_sku_code_series(raw: "pd.Series") -> "pd.Series":
+    """
+    批量版 clean_sku_code：整列清洗（导入按批次调用）
 
+    同一批次里商家编码大量重复（SKU 数远小于行数）：只对去重后的取值逐个清洗，再按值映射回整列，
+    逐行的 Python 调用次数从“行数”降到“不同编码数”。缺失值（None/NaN）返回空串。
+    """
+    values = raw.fillna("").astype(str)
+    cleaned = {value: clean_sku_code(value) for value in values.unique()}
+    return values.map(cleaned)
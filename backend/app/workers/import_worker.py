@@ -8,6 +8,7 @@
 from __future__ import annotations
 
 import asyncio
+import os
 from datetime import datetime
 from typing import Optional, Dict, Any, Tuple
 
@@ -23,39 +24,119 @@ from app.services.stats_service import StatsService
 
 settings = get_settings()
 
+# 新任务入队通知（进程内）：API 入队提交后调用 notify_job_enqueued()，同进程的 worker 立即醒来领取，
+# 不必等满一个轮询间隔；独立进程部署的 worker 收不到通知，仍按 poll_interval 轮询兜底
+_job_enqueued = asyncio.Event()
+
+
+def notify_job_enqueued() -> None:
+    """
+    通知 worker 有新任务入队（尽力而为，丢失时由轮询兜底）
+
+    只置位同一个 Event：连续入队多少次都合并成一次唤醒，不排队、不为每次通知创建任务；
+    醒来的循环会一直领取到队列为空，不会漏掉合并掉的那些任务。
+    """
+    _job_enqueued.set()
+
+
+# 导入中的逐批进度（进程内，task_id -> 进度文案）：逐批进度只是给前端轮询看的临时数据，
+# 不再每批 UPDATE + commit 一次；阶段性进度与最终状态仍写库。独立进程部署时 API 读不到这里，
+# 前端看到的是库里的阶段进度
+_live_progress: Dict[str, str] = {}
+
+
+def get_live_progress(task_id: str) -> Optional[str]:
+    """获取进行中任务的实时进度（没有时返回 None）"""
+    return _live_progress.get(task_id)
+
 
 class ImportWorker:
+    # 每完成多少个任务清理一次旧任务（列表接口只展示最新 15 条，多留几条不影响展示）
+    CLEANUP_EVERY_N_JOBS = 32
+
     def __init__(self):
         self._stop_event = asyncio.Event()
+        # 启动后的第一个任务就清理一次，之后每 CLEANUP_EVERY_N_JOBS 个任务清理一次
+        self._jobs_since_cleanup = self.CLEANUP_EVERY_N_JOBS - 1
+        # 导入锁：多个消费循环时，领取任务到导入写完这一段串行执行，保证订单/售后按入队顺序导入
+        # （售后单从订单复制省份、退货退款触发器回写签收标记，都依赖订单先写入）；重算统计不持锁
+        self._import_lock = asyncio.Lock()
 
     def stop(self):
         self._stop_event.set()
+        # 唤醒正在等待入队通知的循环，尽快退出
+        _job_enqueued.set()
+
+    async def _update_task(self, db: AsyncSession, task_id: str, commit: bool = True, **kwargs):
+        """
+        按 task_id 直接 UPDATE 任务记录（不先查出 ORM 对象；记录不存在时不影响任何行）
+
+        commit=False 时留在当前事务里，由调用方与其他写入一起提交。
+        """
+        if "progress" in kwargs:
+            # 库里的阶段进度更新后，实时进度不能再覆盖它
+            _live_progress.pop(task_id, None)
+        await db.execute(
+            update(ImportTask)
+            .where(ImportTask.task_id == task_id)
+            .values(**kwargs)
+            .execution_options(synchronize_session=False)
+        )
+        if commit:
+            await db.commit()
 
-    async def _update_task(self, db: AsyncSession, task_id: str, **kwargs):
-        stmt = select(ImportTask).where(ImportTask.task_id == task_id)
-        result = await db.execute(stmt)
-        task = result.scalar_one_or_none()
-        if not task:
-            return
-        for key, value in kwargs.items():
-            setattr(task, key, value)
-        await db.commit()
+    def _import_progress(self, task_id: str, label: str):
+        """导入进度回调：每批写入提交后更新进程内的实时进度（不写库）"""
+        async def report(rows: int):
+            _live_progress[task_id] = f"{label}，已导入 {rows} 行..."
+        return report
 
-    async def _cleanup_old_tasks(self, db: AsyncSession, max_tasks: int = 15):
+    async def _cleanup_old_tasks(self, db: AsyncSession, max_tasks: int = 15, commit: bool = True):
         """清理多余的 ImportTask，同时清理对应 ImportJob（按 task_id 关联）"""
-        stmt = select(ImportTask).order_by(ImportTask.started_at.desc())
-        result = await db.execute(stmt)
-        tasks = result.scalars().all()
-        if len(tasks) <= max_tasks:
-            return
-
-        old_task_ids = [t.task_id for t in tasks[max_tasks:]]
-        await db.execute(delete(ImportTask).where(ImportTask.task_id.in_(old_task_ids)))
+        # 在 SQL 里按开始时间倒序跳过最新的 max_tasks 条，不把全部任务读到 Python；
+        # 先删 ImportJob 再删 ImportTask，两次删除用同一个子查询、看到同一份任务表
+        old_task_ids = (
+            select(ImportTask.task_id)
+            .order_by(ImportTask.started_at.desc())
+            .offset(max_tasks)
+            .scalar_subquery()
+        )
         await db.execute(delete(ImportJob).where(ImportJob.task_id.in_(old_task_ids)))
-        await db.commit()
+        await db.execute(delete(ImportTask).where(ImportTask.task_id.in_(old_task_ids)))
+        if commit:
+            await db.commit()
 
     async def _claim_one_job(self, db: AsyncSession) -> Optional[ImportJob]:
-        """尝试领取一个 queued 的任务（通过 update 条件保证多 worker 不重复消费）"""
+        """
+        尝试领取最早的一个 queued 任务
+
+        单条 UPDATE ... RETURNING：挑选与标记在同一条语句（同一把写锁）内完成，多 worker 不会重复消费，
+        也不需要先查、再改、再读回三次往返
+        """
+        if not db.get_bind().dialect.update_returning:
+            return await self._claim_one_job_without_returning(db)
+
+        now = datetime.now()
+        next_job_id = (
+            select(ImportJob.id)
+            .where(ImportJob.status == "queued")
+            .order_by(ImportJob.created_at.asc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        result = await db.execute(
+            update(ImportJob)
+            .where(ImportJob.id == next_job_id, ImportJob.status == "queued")
+            .values(status="processing", picked_at=now, updated_at=now)
+            .returning(ImportJob)
+            .execution_options(synchronize_session=False)
+        )
+        job = result.scalar_one_or_none()
+        await db.commit()
+        return job
+
+    async def _claim_one_job_without_returning(self, db: AsyncSession) -> Optional[ImportJob]:
+        """SQLite < 3.35 不支持 RETURNING：先查再按条件 update，通过 update 条件保证多 worker 不重复消费"""
         result = await db.execute(
             select(ImportJob)
             .where(ImportJob.status == "queued")
@@ -71,34 +152,62 @@ class ImportWorker:
             update(ImportJob)
             .where(ImportJob.id == job.id, ImportJob.status == "queued")
             .values(status="processing", picked_at=now, updated_at=now)
+            # 不按 Python 侧条件同步会话里的 job：没抢到时它不能被改成“本次领取”的样子
+            .execution_options(synchronize_session=False)
         )
         await db.commit()
 
-        if (claim_result.rowcount or 0) != 1:
+        if claim_result.rowcount == 0:
             return None
 
         # 重新读取最新 job
-        refreshed = await db.execute(select(ImportJob).where(ImportJob.id == job.id))
-        return refreshed.scalar_one()
+        refreshed = (
+            await db.execute(
+                select(ImportJob).where(ImportJob.id == job.id).execution_options(populate_existing=True)
+            )
+        ).scalar_one()
+        # 驱动拿不到影响行数（rowcount = -1）时不能据此判断：按领取时间确认是本次领取的，
+        # 既不重复消费别人领走的任务，也不会把自己已标记 processing 的任务丢掉
+        if claim_result.rowcount < 0 and refreshed.picked_at != now:
+            return None
+        return refreshed
 
     def _resolve_paths(self, task_type: str, payload: Optional[Dict[str, Any]]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        解析并校验任务所需的文件路径
+
+        所有需要的文件都在开始导入前检查：缺文件的任务直接失败，
+        不会先导入完订单、写完几次进度后才因为售后文件缺失而失败。
+        """
         payload = payload or {}
         upload_dir = settings.upload_dir
-        orders_filename = payload.get("orders_filename")
-        aftersales_filename = payload.get("aftersales_filename")
+        orders_filename = payload.get("orders_filename") if task_type in ("orders", "all") else None
+        aftersales_filename = payload.get("aftersales_filename") if task_type in ("aftersales", "all") else None
+
+        if task_type in ("orders", "all") and not orders_filename:
+            raise ValueError("缺少 orders 文件")
+        if task_type in ("aftersales", "all") and not aftersales_filename:
+            raise ValueError("缺少 aftersales 文件")
 
         orders_path = f"{upload_dir}/{orders_filename}" if orders_filename else None
         aftersales_path = f"{upload_dir}/{aftersales_filename}" if aftersales_filename else None
+        for path in (orders_path, aftersales_path):
+            if path and not os.path.isfile(path):
+                raise FileNotFoundError(f"上传文件不存在: {path}")
+        return orders_path, aftersales_path
+
+    async def _process_job(self, job: ImportJob, import_lock: Optional[asyncio.Lock] = None):
+        """
+        执行一个导入任务
+
+        import_lock：调用方领取任务前已获取的导入锁，导入写完（开始重算统计前）或任务结束时释放
+        """
+        def release_import_lock():
+            nonlocal import_lock
+            if import_lock is not None:
+                import_lock.release()
+                import_lock = None
 
-        if task_type == "orders":
-            return orders_path, None
-        if task_type == "aftersales":
-            return None, aftersales_path
-        if task_type == "all":
-            return orders_path, aftersales_path
-        return None, None
-
-    async def _process_job(self, job: ImportJob):
         async with async_session_maker() as db:
             try:
                 import_service = ExcelImportService(db)
@@ -109,66 +218,104 @@ class ImportWorker:
                 order_stats = None
                 aftersale_stats = None
 
-                if job.task_type in ("orders", "all"):
-                    if not orders_path:
-                        raise ValueError("缺少 orders 文件")
+                # 每步的导入结果与下一步的进度文案合并成一次更新
+                if orders_path:
                     await self._update_task(db, job.task_id, progress="排队结束，正在导入订单...")
-                    order_stats = await import_service.import_orders(orders_path)
-                    await self._update_task(db, job.task_id, order_stats=order_stats)
-
-                if job.task_type in ("aftersales", "all"):
-                    if not aftersales_path:
-                        raise ValueError("缺少 aftersales 文件")
-                    await self._update_task(db, job.task_id, progress="正在导入售后单...")
-                    aftersale_stats = await import_service.import_aftersales(aftersales_path)
-                    await self._update_task(db, job.task_id, aftersale_stats=aftersale_stats)
+                    order_stats = await import_service.import_orders(
+                        orders_path, on_progress=self._import_progress(job.task_id, "正在导入订单")
+                    )
+                    next_progress = "正在导入售后单..." if job.task_type == "all" else "正在重新计算统计..."
+                    await self._update_task(db, job.task_id, order_stats=order_stats, progress=next_progress)
+
+                if aftersales_path:
+                    if job.task_type == "aftersales":
+                        await self._update_task(db, job.task_id, progress="正在导入售后单...")
+                    aftersale_stats = await import_service.import_aftersales(
+                        aftersales_path, on_progress=self._import_progress(job.task_id, "正在导入售后单")
+                    )
+                    await self._update_task(
+                        db, job.task_id, aftersale_stats=aftersale_stats, progress="正在重新计算统计..."
+                    )
+
+                release_import_lock()
 
                 # 重算统计
-                await self._update_task(db, job.task_id, progress="正在重新计算统计...")
                 sku_stats = await stats_service.calculate_sku_stats()
                 sku_count = await stats_service.save_sku_stats(sku_stats)
 
-                # 标记完成（ImportTask）
+                # 收尾（标记 ImportTask/ImportJob 完成 + 按需清理旧任务）放在同一个事务里，只提交一次，共用一个时间戳
+                now = datetime.now()
                 await self._update_task(
                     db,
                     job.task_id,
+                    commit=False,
                     status="completed",
                     progress="完成",
                     sku_stats_count=sku_count,
-                    completed_at=datetime.now(),
+                    completed_at=now,
                 )
-
-                # 标记完成（ImportJob）
                 await db.execute(
                     update(ImportJob)
                     .where(ImportJob.id == job.id)
-                    .values(status="completed", updated_at=datetime.now())
+                    .values(status="completed", updated_at=now)
                 )
+                self._jobs_since_cleanup += 1
+                if self._jobs_since_cleanup >= self.CLEANUP_EVERY_N_JOBS:
+                    await self._cleanup_old_tasks(db, commit=False)
+                    self._jobs_since_cleanup = 0
                 await db.commit()
-
-                await self._cleanup_old_tasks(db)
             except Exception as e:
-                # 任务失败：记录到 ImportTask + ImportJob
-                await self._update_task(db, job.task_id, status="failed", error=str(e), progress="失败")
+                # 任务失败：ImportTask + ImportJob 在同一个事务里标记失败
+                await self._update_task(db, job.task_id, commit=False, status="failed", error=str(e), progress="失败")
                 await db.execute(
                     update(ImportJob)
                     .where(ImportJob.id == job.id)
                     .values(status="failed", updated_at=datetime.now())
                 )
                 await db.commit()
+            finally:
+                release_import_lock()
+                # 无论如何结束（包括标记失败本身出错、任务被取消），都不留下实时进度，字典大小只与进行中的任务数相关
+                _live_progress.pop(job.task_id, None)
+
+    async def _wait_for_job(self, timeout: float):
+        """空闲时等待入队通知，最多等 timeout 秒"""
+        try:
+            await asyncio.wait_for(_job_enqueued.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # 醒来后总会重新领取一次，通知只需消费一次
+            _job_enqueued.clear()
 
     async def run_forever(self):
+        """
+        按配置的并发数启动消费循环（共用同一个连接池与停止事件；领取是原子的，不会重复领取同一任务）
+
+        导入本身按入队顺序串行（见 _import_lock），并发只让上一个任务的统计重算与下一个任务的导入重叠。
+        """
+        concurrency = max(settings.import_worker_concurrency, 1)
+        await asyncio.gather(*(self._consume_loop() for _ in range(concurrency)))
+
+    async def _consume_loop(self):
         """循环消费队列任务"""
         poll_interval = settings.import_worker_poll_interval
 
         while not self._stop_event.is_set():
             try:
-                async with async_session_maker() as db:
-                    job = await self._claim_one_job(db)
+                # 先取导入锁再领取：领取顺序即导入顺序，锁交给 _process_job 在导入写完后释放
+                await self._import_lock.acquire()
+                try:
+                    async with async_session_maker() as db:
+                        job = await self._claim_one_job(db)
+                except BaseException:
+                    self._import_lock.release()
+                    raise
                 if not job:
-                    await asyncio.sleep(poll_interval)
+                    self._import_lock.release()
+                    await self._wait_for_job(poll_interval)
                     continue
-                await self._process_job(job)
+                await self._process_job(job, self._import_lock)
             except Exception:
                 # 避免 worker 崩溃，短暂休眠再继续
                 await asyncio.sleep(poll_interval)
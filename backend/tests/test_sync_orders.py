@@ -0,0 +1,89 @@
+"""
+订单同步（OrderService.sync_orders）回归测试
+
+用法（在 backend 目录下）：python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+# 必须在导入 app 之前指定临时数据库（engine 在导入 app.database 时创建）
+_DB_DIR = tempfile.mkdtemp(prefix="douyin-sync-test-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select  # noqa: E402
+
+from app import models  # noqa: E402,F401
+from app.database import async_session_maker, init_db  # noqa: E402
+from app.models.order import Order  # noqa: E402
+from app.services.order_service import OrderService  # noqa: E402
+
+BASE_TS = 1735700000
+
+
+class FakeDouyinClient:
+    """按 (订单状态, 物流状态) 返回固定数据的假客户端"""
+
+    def __init__(self, order_status: int, logistics_state: int, update_time: int):
+        self.order_status = order_status
+        self.logistics_state = logistics_state
+        self.update_time = update_time
+        self.logistics_calls = 0
+
+    async def get_order_list(self, start_time, end_time, page, size):
+        if page > 0:
+            return {"shop_order_list": []}
+        return {
+            "shop_order_list": [
+                {"order_id": "O1", "order_status": self.order_status, "update_time": self.update_time}
+            ]
+        }
+
+    async def get_order_detail(self, order_id):
+        return {
+            "shop_order_detail": {
+                "order_status": self.order_status,
+                "create_time": BASE_TS,
+                "pay_time": BASE_TS + 60,
+                "update_time": self.update_time,
+                "post_addr": {"province": {"id": "1", "name": "浙江省"}, "city": {"name": "杭州市"}},
+                "total_amount": 1000,
+                "pay_amount": 900,
+                "sku_order_list": [
+                    {"sku_id": "S1", "code": "C1", "sku_name": "n", "product_id": "p", "product_name": "pn",
+                     "item_num": 1, "price": 900}
+                ],
+            }
+        }
+
+    async def get_logistics_track(self, order_id):
+        self.logistics_calls += 1
+        return {"track_list": [{"state": self.logistics_state, "time": self.update_time}]}
+
+
+async def _sync(client: FakeDouyinClient) -> Order:
+    async with async_session_maker() as db:
+        await OrderService(db, client).sync_orders(datetime(2025, 1, 1), datetime(2025, 2, 1))
+    async with async_session_maker() as db:
+        return (await db.execute(select(Order).where(Order.order_id == "O1"))).scalar_one()
+
+
+def test_shipped_order_completed_before_next_sync_becomes_signed():
+    async def run():
+        await init_db()
+        # 第一次同步：已发货、物流在途
+        order = await _sync(FakeDouyinClient(order_status=3, logistics_state=2, update_time=BASE_TS + 100))
+        assert order.order_status == 3
+        assert not order.is_signed
+
+        # 第二次同步前订单已完成：仍需查询物流，签收状态才能被记录
+        client = FakeDouyinClient(order_status=5, logistics_state=3, update_time=BASE_TS + 200)
+        order = await _sync(client)
+        assert client.logistics_calls == 1
+        assert order.order_status == 5
+        assert order.is_signed
+
+    asyncio.run(run())
@@ -40,6 +40,7 @@ interface StatsSummary {
   total_stock_gap: number
   last_import_time: string | null
   last_calculated_at: string | null
+  pending_refresh_days: number
 }
 
 export default function Home() {